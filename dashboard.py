@@ -1,3 +1,4 @@
+import datetime
 import json
 import os
 import sqlite3
@@ -7,6 +8,7 @@ from dash.dependencies import Input, Output
 import plotly.express as px
 import threading
 import time
+from ez_config_loader import ConfigLoader
 
 app = Dash(__name__)
 app.title = "Real-Time Cleaning Metrics Dashboard"
@@ -22,6 +24,14 @@ app.layout = html.Div([
     dcc.Graph(id='bar-machine'),
 ])
 
+def rollup_for(window):
+    """The coarsest rollup that still gives a detailed line over the window."""
+    if window <= 6 * 3600:
+        return 'minute'
+    if window <= 14 * 86400:
+        return 'hour'
+    return 'day'
+
 @app.callback(
     [Output('metrics', 'children'),
      Output('line-chart', 'figure'),
@@ -31,14 +41,25 @@ app.layout = html.Div([
     [Input('interval', 'n_intervals')]
 )
 def update_dashboard(n):
-    df = pd.read_sql_query("SELECT * FROM transactions", conn)
+    # Only the last DASHBOARD_WINDOW seconds, read from the rollups the subscriber maintains instead of raw rows
+    since = int(time.time() - DASHBOARD_WINDOW)
+    rollup = rollup_for(DASHBOARD_WINDOW)
+    df = pd.read_sql_query(f"""
+        SELECT r.bucket, plant.name AS plant_id, building.name AS building_id, machine.name AS machine_id,
+               r.count, r.sum_dli AS dli, r.sum_sri AS sri, r.sum_odi AS odi
+        FROM rollup_{rollup} r
+        LEFT JOIN plant ON plant.id = r.plant
+        LEFT JOIN building ON building.id = r.building
+        LEFT JOIN machine ON machine.id = r.machine
+        WHERE r.bucket >= ?
+    """, conn, params=(since,))
     num_plants = df['plant_id'].nunique()
     num_buildings = df['building_id'].nunique()
     num_machines = df['machine_id'].nunique()
-    num_txns = len(df)
-    avg_dli = df['dli'].mean()
-    avg_sri = df['sri'].mean()
-    avg_odi = df['odi'].mean()
+    num_txns = df['count'].sum()
+    avg_dli = df['dli'].sum() / num_txns if num_txns else float('nan')
+    avg_sri = df['sri'].sum() / num_txns if num_txns else float('nan')
+    avg_odi = df['odi'].sum() / num_txns if num_txns else float('nan')
     metrics = html.Div([
         html.P(f"Number of Plants: {num_plants}"),
         html.P(f"Number of Buildings: {num_buildings}"),
@@ -46,14 +67,22 @@ def update_dashboard(n):
         html.P(f"Number of Transactions: {num_txns}"),
         html.P(f"Average DLI: {avg_dli:.2f}, SRI: {avg_sri:.2f}, ODI: {avg_odi:.2f}"),
     ])
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    fig_line = px.line(df.sort_values('timestamp'), x='timestamp', y=['dli', 'sri', 'odi'], title="Cleaning Metrics Over Time")
-    fig_plant = px.bar(df, x='plant_id', y='dli', title='DLI per Plant', barmode='group')
-    fig_building = px.bar(df, x='building_id', y='sri', title='SRI per Building', barmode='group')
-    fig_machine = px.bar(df, x='machine_id', y='odi', title='ODI per Machine', barmode='group')
+    # Average per bucket over all machines, buckets are UTC epoch seconds
+    line = df.groupby('bucket')[['count', 'dli', 'sri', 'odi']].sum()
+    line[['dli', 'sri', 'odi']] = line[['dli', 'sri', 'odi']].div(line['count'], axis=0)
+    line['timestamp'] = pd.to_datetime(line.index, unit='s', utc=True).tz_convert(datetime.datetime.now().astimezone().tzinfo)
+    fig_line = px.line(line.sort_values('timestamp'), x='timestamp', y=['dli', 'sri', 'odi'], title=f"Cleaning Metrics Over Time (per {rollup})")
+    # Bar heights are the sums of the readings, as when every reading was its own bar segment
+    fig_plant = px.bar(df.groupby('plant_id', as_index=False)['dli'].sum(), x='plant_id', y='dli', title='DLI per Plant', barmode='group')
+    fig_building = px.bar(df.groupby('building_id', as_index=False)['sri'].sum(), x='building_id', y='sri', title='SRI per Building', barmode='group')
+    fig_machine = px.bar(df.groupby('machine_id', as_index=False)['odi'].sum(), x='machine_id', y='odi', title='ODI per Machine', barmode='group')
     return metrics, fig_line, fig_plant, fig_building, fig_machine
 
 if __name__ == '__main__':
+    # Load values from the configuration
+    config = ConfigLoader("config.json")
+    # Seconds of history shown
+    DASHBOARD_WINDOW = config.get("dashboard.window", 3600)
     # NOTE: environment variables must be sourced in advance
     SQLITE_DB_NAME = os.environ["SQLITE_DB_NAME"]
     # Create connection
@@ -0,0 +1,81 @@
+# general
+import collections
+import random
+import threading
+import time
+# analytics
+import numpy as np
+from sklearn.ensemble import IsolationForest
+from sklearn.preprocessing import StandardScaler
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+class IncrementalDetector:
+    """IsolationForest that scores new readings only, retrained in the background on a bounded sample.
+
+    The training sample is a sliding window of the latest readings or a reservoir sample of all
+    readings seen, either way at most window rows, so training cost does not grow with the table.
+    A retrain starts every retrain_every new readings and swaps in the new scaler and model as one
+    tuple when done, scoring keeps using the previous model until then."""
+    def __init__(self, window=5000, retrain_every=1000, sampling="sliding", min_samples=10, contamination=0.05, random_state=42):
+        self.window = window
+        self.retrain_every = retrain_every
+        self.sampling = sampling
+        self.min_samples = min_samples
+        self.contamination = contamination
+        self.random_state = random_state
+        self.sample = collections.deque(maxlen=window) if sampling == "sliding" else []
+        self.seen = 0
+        self.since_training = 0
+        # (scaler, model), replaced by a single assignment so scoring never sees half a model
+        self.model = None
+        self.training = None
+        self.lock = threading.Lock()
+        self.random = random.Random(random_state)
+
+    def add(self, rows):
+        """Adds feature rows to the training sample, starting a retrain when due."""
+        with self.lock:
+            for row in rows:
+                self.seen += 1
+                if self.sampling == "sliding" or len(self.sample) < self.window:
+                    self.sample.append(tuple(row))
+                else:
+                    # Reservoir sampling: every reading seen so far has the same chance to be in the sample
+                    index = self.random.randrange(self.seen)
+                    if index < self.window:
+                        self.sample[index] = tuple(row)
+            self.since_training += len(rows)
+            due = self.since_training >= self.retrain_every or (self.model is None and len(self.sample) >= self.min_samples)
+            if not due or (self.training is not None and self.training.is_alive()):
+                return
+            self.since_training = 0
+            sample = np.array(self.sample, dtype=float)
+            self.training = threading.Thread(target=self.train, args=(sample,), name="model-training", daemon=True)
+            self.training.start()
+
+    def train(self, sample):
+        start = time.perf_counter()
+        scaler = StandardScaler()
+        X_scaled = scaler.fit_transform(sample)
+        model = IsolationForest(contamination=self.contamination, random_state=self.random_state)
+        model.fit(X_scaled)
+        self.model = (scaler, model)
+        tprint(f"Anomaly model trained on {len(sample)} readings in {time.perf_counter() - start:.2f}s")
+
+    def score(self, rows):
+        """Returns (anomaly_score, is_anomaly) arrays for feature rows, None before the first model is trained."""
+        current = self.model
+        if current is None:
+            return None
+        scaler, model = current
+        X_scaled = scaler.transform(np.asarray(rows, dtype=float))
+        return model.decision_function(X_scaled), model.predict(X_scaled)
+
+    def wait(self, timeout=None):
+        """Waits for a running retrain, for tests and shutdown."""
+        training = self.training
+        if training is not None:
+            training.join(timeout)
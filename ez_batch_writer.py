@@ -0,0 +1,142 @@
+# general
+import queue
+import threading
+import time
+
+# Rows per written batch, from a single row up to well past the default max_rows
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+class BatchWriter:
+    """Group commit: collects rows from the broker callback and writes them in batches on one thread.
+
+    A batch is written when it has max_rows rows or its first row waited max_delay_ms, with a single
+    call of flush_func(rows). Only after flush_func returned, on_flushed(contexts) gets the context
+    of every row, e.g. the broker messages to acknowledge. A failed batch is retried max_retries times,
+    then written row by row so one bad row does not hold up the others. Only a row that fails with one
+    of data_errors, an error of the row itself, is logged and skipped, its context passed on as done.
+    Any other error means the store is failing, e.g. locked or unreachable: that row and the ones after
+    it are kept and retried with the next batch, never acknowledged without being written. With a
+    MetricsRegistry the write time and rows of every flush_func call and the failed and skipped writes
+    are recorded, the commit is where a subscriber spends its time."""
+    def __init__(self, flush_func, max_rows=500, max_delay_ms=50, on_flushed=None, max_pending=None, retry_delay=1, max_retries=3,
+                 data_errors=(KeyError, TypeError, ValueError), metrics=None, name="batch-writer"):
+        self.flush_func = flush_func
+        self.on_flushed = on_flushed
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.data_errors = data_errors
+        # Bounded, submit blocks the broker callback when writing falls behind so the broker holds the messages
+        self.pending = queue.Queue(maxsize=max_pending or max_rows * 4)
+        self.stopping = False
+        self.batches = 0
+        self.rows = 0
+        self.skipped = 0
+        if metrics is not None:
+            self.flush_seconds = metrics.histogram("subscriber_flush_seconds", "Time to write one batch to the store, commit included")
+            self.flush_rows = metrics.histogram("subscriber_batch_rows", "Rows per batch written to the store", buckets=BATCH_BUCKETS)
+            self.flush_failed = metrics.counter("subscriber_flush_failures_total", "Failed writes of a batch or a single row")
+            self.skipped_rows = metrics.counter("subscriber_rows_skipped_total", "Rows acknowledged without being written because the store rejects them")
+        else:
+            self.flush_seconds = self.flush_rows = self.flush_failed = self.skipped_rows = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, row, context=None):
+        self.pending.put((row, context))
+
+    def qsize(self):
+        return self.pending.qsize()
+
+    def collect(self, limit=None):
+        """Waits for a first row, then gathers more until the batch has limit rows or its delay is up."""
+        limit = self.max_rows if limit is None else limit
+        if limit <= 0:
+            return []
+        try:
+            batch = [self.pending.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < limit:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, rows):
+        """flush_func(rows), timed and counted in the metrics."""
+        start = time.perf_counter()
+        try:
+            self.flush_func(rows)
+        except Exception:
+            if self.flush_failed:
+                self.flush_failed.inc()
+            raise
+        if self.flush_seconds:
+            self.flush_seconds.observe(time.perf_counter() - start)
+            self.flush_rows.observe(len(rows))
+
+    def write(self, batch):
+        """Writes (row, context) pairs, returns the pairs done, written or skipped, and those to retry."""
+        rows = [row for row, _ in batch]
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.flush(rows)
+                return batch, []
+            except self.data_errors as e:
+                # A row of the batch is bad, retrying the whole batch would fail the same way
+                tprint(f"Writing a batch of {len(rows)} rows failed: {e!r}")
+                break
+            except Exception as e:
+                tprint(f"Writing a batch of {len(rows)} rows failed ({attempt}/{self.max_retries}): {e}")
+                time.sleep(self.retry_delay)
+        if len(batch) > 1:
+            tprint(f"Writing the {len(rows)} rows one by one")
+        done = []
+        for i, item in enumerate(batch):
+            try:
+                self.flush([item[0]])
+            except self.data_errors as e:
+                tprint(f"Skipping a row that cannot be stored, acknowledging it: {e!r}")
+                self.skipped += 1
+                if self.skipped_rows:
+                    self.skipped_rows.inc()
+            except Exception as e:
+                # The store is failing rather than the row, keep this row and the rest unacknowledged
+                tprint(f"Writing a row failed, keeping {len(batch) - i} rows to retry: {e}")
+                return done, batch[i:]
+            done.append(item)
+        return done, []
+
+    def run(self):
+        # Rows no write succeeded for, retried together with the next rows
+        retry = []
+        while not (self.stopping and self.pending.empty() and not retry):
+            batch = retry + self.collect(self.max_rows - len(retry))
+            if not batch:
+                continue
+            done, retry = self.write(batch)
+            if retry:
+                time.sleep(self.retry_delay)
+            if not done:
+                continue
+            self.batches += 1
+            self.rows += len(done)
+            if self.on_flushed:
+                try:
+                    self.on_flushed([context for _, context in done])
+                except Exception as e:
+                    tprint(f"Acknowledging a batch of {len(done)} rows failed: {e}")
+
+    def close(self, timeout=10):
+        """Writes the rows still pending and stops the writer thread."""
+        self.stopping = True
+        self.thread.join(timeout)
@@ -0,0 +1,309 @@
+# general
+import argparse
+import datetime
+import gzip
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from urllib.parse import urlparse
+# ez
+from ez_config_loader import ConfigLoader
+import requests
+from ez_machine import create_soap_message, create_reading, send_message, get_solace_rest_url, SoapTemplate
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+def percentile(sorted_values, pct):
+    """Returns the pct percentile of an already sorted list, nearest-rank method."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def report(name, latencies, errors, elapsed, rejected=0):
+    """Prints throughput and latency percentiles in milliseconds."""
+    latencies.sort()
+    total = len(latencies) + errors + rejected
+    tprint(f"{name}: {total} requests in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} req/s, {errors} errors, {rejected} rejected (503)")
+    if latencies:
+        tprint(
+            f"{name}: latency ms p50={percentile(latencies, 50) * 1000:.2f} "
+            f"p90={percentile(latencies, 90) * 1000:.2f} "
+            f"p99={percentile(latencies, 99) * 1000:.2f} "
+            f"p999={percentile(latencies, 99.9) * 1000:.2f} "
+            f"max={latencies[-1] * 1000:.2f}"
+        )
+
+def sample_message():
+    """A representative reading, built once so the benchmark measures the gateway and not the generator."""
+    payload = f"[{datetime.datetime.now().isoformat()}] Dust level: moderate, Sticky residue: present, Odor: normal. Cleaning: recommended."
+    return create_soap_message('plant1', 'building1', 'machine1', payload, 80, 70, 10).encode('utf-8')
+
+def sample_batch(size):
+    """The sample reading repeated size times as Payload/Document entries of one envelope."""
+    soap_xml = sample_message().decode('utf-8')
+    start = soap_xml.index('<Document>')
+    end = soap_xml.index('</Document>') + len('</Document>')
+    return (soap_xml[:start] + soap_xml[start:end] * size + soap_xml[end:]).encode('utf-8')
+
+def machine_list(ranges):
+    """All (plant_id, building_id, machine_id) for the number of plants, buildings per plant and machines per building."""
+    plants, buildings, machines = ranges
+    return [
+        (f"plant{p}", f"building{b}", f"machine{m}")
+        for p in range(1, plants + 1)
+        for b in range(1, buildings + 1)
+        for m in range(1, machines + 1)
+    ]
+
+def gateway_client(url, body, count, keepalive, compress, latencies, errors, rejected, lock):
+    """Sends count requests to the gateway, over one persistent connection when keepalive is set."""
+    parsed = urlparse(url)
+    headers = {
+        'Content-Type': 'text/xml; charset=utf-8',
+        'SOAPAction': 'ebMS',
+        'machine-id': 'machine1'
+    }
+    if not keepalive:
+        headers['Connection'] = 'close'
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Accept-Encoding'] = 'gzip'
+    local_latencies = []
+    local_errors = 0
+    local_rejected = 0
+    conn = None
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=10)
+            conn.request('POST', parsed.path or '/', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                local_latencies.append(time.perf_counter() - start)
+            elif response.status == 503:
+                local_rejected += 1
+            else:
+                local_errors += 1
+            if not keepalive or response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            local_errors += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+        rejected.append(local_rejected)
+
+def bench_gateway(url, requests_total, concurrency, keepalive, batch=1, compress=False):
+    """Closed-loop throughput/latency benchmark against a running gateway."""
+    if batch > 1:
+        body = sample_batch(batch)
+        url = url.rstrip('/') + '/batch'
+    else:
+        body = sample_message()
+    if compress:
+        body = gzip.compress(body, compresslevel=6)
+    latencies = []
+    errors = []
+    rejected = []
+    lock = threading.Lock()
+    per_client = max(1, requests_total // concurrency)
+    threads = [
+        threading.Thread(target=gateway_client, args=(url, body, per_client, keepalive, compress, latencies, errors, rejected, lock), daemon=True)
+        for _ in range(concurrency)
+    ]
+    tprint(f"Sending {per_client * concurrency} requests of {len(body)} bytes to {url} over {concurrency} {'persistent' if keepalive else 'new'} connections")
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    report("gateway", latencies, sum(errors), elapsed, sum(rejected))
+    if batch > 1:
+        tprint(f"gateway: {len(latencies) * batch / elapsed:.1f} readings/s in batches of {batch}")
+
+class OpenLoopLoad:
+    """Sends requests on a fixed rate schedule, whether or not earlier requests have been answered.
+
+    Latency is measured from the intended send time, so when the target slows down the time a request
+    waited for a free sender counts too instead of being hidden (coordinated omission)."""
+    def __init__(self, name, url_for, rate, duration, senders, compress=False, ranges=(3, 2, 4)):
+        self.name = name
+        self.machines = machine_list(ranges)
+        self.template = SoapTemplate()
+        self.url_for = url_for
+        self.rate = rate
+        self.total = int(rate * duration)
+        self.senders = senders
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.latencies = []
+        self.errors = 0
+
+    def next_request(self):
+        with self.lock:
+            if self.next_index >= self.total:
+                return None
+            self.next_index += 1
+            return self.next_index - 1
+
+    def sender(self):
+        session = requests.Session()
+        latencies = []
+        errors = 0
+        while True:
+            index = self.next_request()
+            if index is None:
+                break
+            intended = self.start + index / self.rate
+            # Generated before waiting for the send time, outside of the measured send, and stamped with that time
+            plant_id, building_id, machine_id, soap_message = self.template.generate(self.machines, 1, [time.time() + intended - time.perf_counter()])[0]
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            url = self.url_for(plant_id, building_id, machine_id)
+            if send_message(url, soap_message, machine_id, self.compress, session) is None:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - intended)
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+
+    def run(self):
+        tprint(f"{self.name}: {self.total} requests at {self.rate} req/s with {self.senders} senders")
+        self.start = time.perf_counter()
+        threads = [threading.Thread(target=self.sender, daemon=True) for _ in range(self.senders)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        report(self.name, self.latencies, self.errors, time.perf_counter() - self.start)
+
+def bench_load(target, gateway_url, topic, rate, duration, senders, compress, ranges):
+    """Open-loop load on the gateway and/or the Solace REST API, both run at the target rate at the same time."""
+    loads = []
+    if target in ("gateway", "both"):
+        loads.append(OpenLoopLoad("gateway", lambda p, b, m: gateway_url, rate, duration, senders, compress, ranges))
+    if target in ("rest", "both"):
+        rest_url = get_solace_rest_url()
+        loads.append(OpenLoopLoad("rest", lambda p, b, m: f"{rest_url}/{topic}/xml/v1/{p}/{b}/{m}", rate, duration, senders, ranges=ranges))
+    threads = [threading.Thread(target=load.run) for load in loads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def bench_extract(iterations):
+    """Per message cost of the single-pass extract_soap_data against the per-element tree scans."""
+    # Imported here, the gateway module needs the solace package which the HTTP benchmark does not
+    from ez_gateway import extract_soap_data, extract_soap_data_legacy
+    soap_xml = sample_message().decode('utf-8')
+    if extract_soap_data(soap_xml) != extract_soap_data_legacy(soap_xml):
+        tprint("extract: single-pass and legacy results differ")
+    results = {}
+    for name, func in (("legacy", extract_soap_data_legacy), ("single-pass", extract_soap_data)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func(soap_xml)
+        results[name] = (time.perf_counter() - start) / iterations
+        tprint(f"extract {name}: {results[name] * 1e6:.2f} us/message")
+    tprint(f"extract: single-pass is {results['legacy'] / results['single-pass']:.2f}x the legacy speed")
+
+def bench_generate(count, ranges):
+    """Messages per second of create_reading against the pre-compiled SoapTemplate."""
+    machines = machine_list(ranges)
+    start = time.perf_counter()
+    for _ in range(count):
+        create_reading(*random.choice(machines))
+    create_rate = count / (time.perf_counter() - start)
+    tprint(f"generate create_reading: {create_rate:.0f} messages/s")
+    template = SoapTemplate()
+    start = time.perf_counter()
+    for _ in range(0, count, 1000):
+        template.generate(machines, 1000)
+    template_rate = count / (time.perf_counter() - start)
+    tprint(f"generate SoapTemplate: {template_rate:.0f} messages/s, {template_rate / create_rate:.1f}x")
+
+def bench_sqlite(count, batch_rows, synchronous):
+    """Insert rate of a commit per transaction against batched group commits, on a scratch database."""
+    import os
+    import tempfile
+    # Imported here, the subscriber and gateway modules need the solace and analytics packages
+    from subscriber_sqlite import initialize_db, insert_transactions
+    from ez_sqlite_schema import Dimensions
+    from ez_gateway import extract_soap_data, build_json_message
+    transaction = json.loads(build_json_message(extract_soap_data(sample_message().decode('utf-8'))))
+    # Distinct message ids, repeats of one message would be stored once
+    transactions = [dict(transaction, messageid=str(i)) for i in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        rates = {}
+        for name, size in (("per-row", 1), ("batched", batch_rows)):
+            conn = initialize_db(os.path.join(directory, f"{name}.db"), synchronous)
+            dimensions = Dimensions(conn)
+            start = time.perf_counter()
+            for first in range(0, count, size):
+                insert_transactions(conn, transactions[first:first + size], dimensions=dimensions)
+            rates[name] = count / (time.perf_counter() - start)
+            conn.close()
+            tprint(f"sqlite {name}: {rates[name]:.0f} inserts/s")
+    tprint(f"sqlite: batches of {batch_rows} are {rates['batched'] / rates['per-row']:.1f}x a commit per row")
+
+if __name__ == "__main__":
+    # Load values from the configuration
+    config = ConfigLoader("config.json")
+    APP_URL = config.get("app.url")
+    APP_TOPIC = config.get("app.topic")
+    MACHINE_RANGES = (config.get("machine.plants", 3), config.get("machine.buildings", 2), config.get("machine.machines", 4))
+
+    parser = argparse.ArgumentParser(description="Cleanpulse gateway benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    gateway_parser = subparsers.add_parser("gateway", help="throughput/latency of a running gateway")
+    gateway_parser.add_argument("-n", "--requests", type=int, default=10000)
+    gateway_parser.add_argument("-c", "--concurrency", type=int, default=50)
+    gateway_parser.add_argument("--no-keepalive", action="store_true", help="open a new connection per request")
+    gateway_parser.add_argument("--url", default=APP_URL)
+    gateway_parser.add_argument("--batch", type=int, default=1, help="readings per POST to the /batch endpoint")
+    gateway_parser.add_argument("--gzip", action="store_true", help="gzip request bodies and accept gzip responses")
+    load_parser = subparsers.add_parser("load", help="open-loop load at a fixed request rate")
+    load_parser.add_argument("--target", choices=("gateway", "rest", "both"), default="gateway")
+    load_parser.add_argument("-r", "--rate", type=float, default=100, help="requests per second per target")
+    load_parser.add_argument("-d", "--duration", type=float, default=30, help="seconds")
+    load_parser.add_argument("-s", "--senders", type=int, default=64, help="sender threads per target")
+    load_parser.add_argument("--gzip", action="store_true", help="gzip request bodies to the gateway")
+    load_parser.add_argument("--url", default=APP_URL)
+    extract_parser = subparsers.add_parser("extract", help="per message cost of extract_soap_data")
+    extract_parser.add_argument("-n", "--iterations", type=int, default=20000)
+    generate_parser = subparsers.add_parser("generate", help="messages per second of the SOAP message generator")
+    generate_parser.add_argument("-n", "--count", type=int, default=100000)
+    sqlite_parser = subparsers.add_parser("sqlite", help="insert rate of the sqlite subscriber, per row and batched")
+    sqlite_parser.add_argument("-n", "--count", type=int, default=5000)
+    sqlite_parser.add_argument("--batch", type=int, default=config.get("sqlite.batch_rows", 500))
+    sqlite_parser.add_argument("--synchronous", default=config.get("sqlite.synchronous", "FULL"))
+    args = parser.parse_args()
+
+    if args.benchmark == "gateway":
+        bench_gateway(args.url, args.requests, args.concurrency, not args.no_keepalive, args.batch, args.gzip)
+    elif args.benchmark == "load":
+        bench_load(args.target, args.url, APP_TOPIC, args.rate, args.duration, args.senders, args.gzip, MACHINE_RANGES)
+    elif args.benchmark == "extract":
+        bench_extract(args.iterations)
+    elif args.benchmark == "generate":
+        bench_generate(args.count, MACHINE_RANGES)
+    elif args.benchmark == "sqlite":
+        bench_sqlite(args.count, args.batch, args.synchronous)
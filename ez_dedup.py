@@ -0,0 +1,53 @@
+# general
+import collections
+import threading
+
+# extract_soap_data value of a missing element, never a usable id
+UNKNOWN = "Unknown"
+
+def message_id(transaction):
+    """The ebXML MessageId of a parsed transaction, None when the gateway did not find one."""
+    value = transaction.get('messageid')
+    return None if value in (None, "", UNKNOWN) else value
+
+class RecentIdCache:
+    """The last capacity message ids seen, least recently used first out.
+
+    Redeliveries after a reconnect or restart arrive shortly after the original, so a bounded
+    in-memory set answers most duplicate checks without a database round trip. The store's unique
+    index or MERGE stays the backstop for older ids and for other subscriber processes. Any hashable
+    works as id, subscriber_neo4j also keeps the dimension relationships it merged in one."""
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, id):
+        if id is None:
+            return False
+        with self.lock:
+            if id not in self.ids:
+                return False
+            self.ids.move_to_end(id)
+            return True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+    def add(self, id):
+        self.update((id,))
+
+    def update(self, ids):
+        """Remembers ids once they are stored, evicting the least recently used beyond capacity."""
+        with self.lock:
+            for id in ids:
+                if id is None:
+                    continue
+                self.ids[id] = None
+                self.ids.move_to_end(id)
+            while len(self.ids) > self.capacity:
+                self.ids.popitem(last=False)
@@ -0,0 +1,85 @@
+# general
+import queue
+import threading
+import time
+import zlib
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+def machine_key(message):
+    """plant/building/machine of a message on <app topic>/json/v1/<plant>/<building>/<machine>/<levels...>.
+
+    The topic levels after the machine change with every reading, a key on the full topic would
+    spread one machine's readings over the workers."""
+    topic = message.get_destination_name() or ""
+    return "/".join(topic.split("/json/v1/", 1)[-1].split("/")[:3])
+
+class KeyedDispatcher:
+    """Hands broker messages from the Solace API dispatch thread to a pool of worker threads.
+
+    Messages with the same key always go to the same worker, so the messages of one machine are
+    processed in the order they arrived while different machines are processed in parallel. Every
+    worker has a bounded queue, when it is full dispatch() blocks and the broker holds back further
+    messages. After handler(message) returns, on_done(message) is called, e.g. to acknowledge it.
+    When the handler raises, the message is counted as failed and left unacknowledged: the broker
+    does not redeliver it while the flow is up, only after the flow reconnects, e.g. on a restart.
+    The processing time is that of handler alone, a subscriber whose handler hands the message to a
+    BatchWriter has the write time in that writer's metrics."""
+    def __init__(self, handler, key_func, workers=4, queue_size=1000, on_done=None, metrics=None, name="dispatch"):
+        self.handler = handler
+        self.key_func = key_func
+        self.on_done = on_done
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.stopping = False
+        if metrics is not None:
+            for i, worker_queue in enumerate(self.queues):
+                metrics.gauge("subscriber_worker_queue_depth", "Messages waiting per worker", callback=worker_queue.qsize, worker=str(i))
+            self.duration = metrics.histogram("subscriber_processing_seconds", "Time to process one message, without the batch write")
+            self.processed = metrics.counter("subscriber_messages_total", "Messages processed", result="ok")
+            # Not acknowledged, these stay on the queue until the flow reconnects
+            self.failed = metrics.counter("subscriber_messages_total", "Messages processed", result="error")
+        else:
+            self.duration = self.processed = self.failed = None
+        self.threads = [threading.Thread(target=self.run, args=(worker_queue,), name=f"{name}-{i}", daemon=True) for i, worker_queue in enumerate(self.queues)]
+        for t in self.threads:
+            t.start()
+
+    def dispatch(self, message):
+        key = self.key_func(message) or ""
+        # crc32 rather than hash(), the same key picks the same worker in every run
+        self.queues[zlib.crc32(key.encode('utf-8')) % len(self.queues)].put(message)
+
+    def qsize(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def run(self, worker_queue):
+        while not (self.stopping and worker_queue.empty()):
+            try:
+                message = worker_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            try:
+                self.handler(message)
+            except Exception as e:
+                tprint(f"Processing message failed, it stays unacknowledged until the flow reconnects: {e}")
+                if self.failed:
+                    self.failed.inc()
+                continue
+            if self.duration:
+                self.duration.observe(time.perf_counter() - start)
+                self.processed.inc()
+            if self.on_done:
+                try:
+                    self.on_done(message)
+                except Exception as e:
+                    tprint(f"Acknowledging message failed: {e}")
+
+    def close(self, timeout=10):
+        """Processes the messages still queued and stops the workers."""
+        self.stopping = True
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0, deadline - time.monotonic()))
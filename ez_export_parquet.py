@@ -0,0 +1,148 @@
+# general
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import time
+# analytics, optional: only this exporter needs pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+# ez
+from ez_config_loader import ConfigLoader
+from ez_sqlite_schema import FIELDS, SCHEMA_VERSION
+
+# Export state in the export directory: the id of the last exported reading
+STATE_FILE = "_export_state.json"
+LEVELS = ('dli', 'sri', 'odi')
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            return json.load(f).get("last_id", 0)
+    except (OSError, ValueError):
+        return 0
+
+def save_state(out_dir, last_id):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"last_id": last_id, "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+    os.replace(path + ".tmp", path)
+
+def load_dictionaries(conn):
+    """Per dimension table the names ordered by id and the id -> position lookup, for dictionary-encoded columns."""
+    dictionaries = {}
+    for dimension in set(FIELDS.values()):
+        names = []
+        positions = {}
+        for id, name in conn.execute(f"SELECT id, name FROM {dimension} ORDER BY id"):
+            positions[id] = len(names)
+            names.append(name)
+        dictionaries[dimension] = (pa.array(names, pa.string()), positions)
+    return dictionaries
+
+def schema():
+    columns = [pa.field('id', pa.int64())]
+    for field, dimension in FIELDS.items():
+        if field != 'plant_id':
+            columns.append(pa.field(field, pa.dictionary(pa.int32(), pa.string())))
+    columns.append(pa.field('timestamp', pa.timestamp('us', tz='UTC')))
+    columns += [pa.field(level, pa.int16()) for level in LEVELS]
+    # Only set when the payload differs from the sentence rebuilt from the other columns
+    columns.append(pa.field('payload', pa.string()))
+    # The ebXML MessageId, null for readings stored before it was kept
+    columns.append(pa.field('messageid', pa.string()))
+    return pa.schema(columns)
+
+def to_table(rows, dictionaries, table_schema):
+    """Arrow table of readings rows (id, dimension ids..., timestamp, dli, sri, odi, payload, messageid) without plant."""
+    columns = list(zip(*rows))
+    arrays = [pa.array(columns[0], pa.int64())]
+    for i, (field, dimension) in enumerate(FIELDS.items(), start=1):
+        if field == 'plant_id':
+            continue
+        names, positions = dictionaries[dimension]
+        indices = pa.array([positions.get(id) for id in columns[i]], pa.int32())
+        arrays.append(pa.DictionaryArray.from_arrays(indices, names))
+    offset = 1 + len(FIELDS)
+    arrays.append(pa.array(columns[offset], pa.int64()).cast(pa.timestamp('us', tz='UTC')))
+    arrays += [pa.array(columns[offset + 1 + i], pa.int16()) for i in range(len(LEVELS))]
+    arrays.append(pa.array(columns[offset + 4], pa.string()))
+    arrays.append(pa.array(columns[offset + 5], pa.string()))
+    return pa.Table.from_arrays(arrays, schema=table_schema)
+
+def export(db_name, out_dir, chunk_size=100000, compression="zstd"):
+    """Exports the readings added since the last export to Parquet files partitioned by date and plant.
+
+    Files are written as <out_dir>/date=YYYY-MM-DD/plant=<plant>/part-<first id>.parquet (hive partitioning,
+    date of the UTC timestamp), readable with pandas.read_parquet(out_dir) or pyarrow.dataset. After every
+    chunk the last exported id is saved, an interrupted export rewrites the same files on the next run."""
+    if pa is None:
+        tprint("pyarrow is not installed, run: python3 -m pip install pyarrow")
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    # Read-only, the subscriber keeps writing while the export runs
+    conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        tprint(f"Database schema version {version}, start subscriber_sqlite.py once to migrate it to {SCHEMA_VERSION}")
+        return
+    last_id = load_state(out_dir)
+    # Rows up to max_id are committed, so are their dimension names, which are loaded after it
+    max_id = conn.execute("SELECT MAX(id) FROM readings").fetchone()[0] or 0
+    dictionaries = load_dictionaries(conn)
+    plants = dict(conn.execute("SELECT id, name FROM plant"))
+    table_schema = schema()
+    select = (
+        "SELECT r.id, r.plant, r.building, r.machine, r.conversation, r.cpa, r.service, r.action, r.dust, r.sticky, r.odor, r.cleaning,"
+        " r.timestamp, r.dli, r.sri, r.odi, r.payload, r.messageid FROM readings r WHERE r.id > ? AND r.id <= ? ORDER BY r.id LIMIT ?"
+    )
+    exported = 0
+    files = 0
+    start = time.perf_counter()
+    while last_id < max_id:
+        rows = conn.execute(select, (last_id, max_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        first_id = rows[0][0]
+        partitions = {}
+        for row in rows:
+            timestamp_us = row[12]
+            date = datetime.datetime.fromtimestamp(timestamp_us / 1000000, datetime.timezone.utc).strftime("%Y-%m-%d") if timestamp_us is not None else "unknown"
+            plant = plants.get(row[1], "unknown")
+            partitions.setdefault((date, plant), []).append(row)
+        for (date, plant), partition_rows in partitions.items():
+            directory = os.path.join(out_dir, f"date={date}", f"plant={plant}")
+            os.makedirs(directory, exist_ok=True)
+            pq.write_table(to_table(partition_rows, dictionaries, table_schema), os.path.join(directory, f"part-{first_id:012d}.parquet"), compression=compression)
+            files += 1
+        last_id = rows[-1][0]
+        exported += len(rows)
+        save_state(out_dir, last_id)
+    conn.close()
+    tprint(f"Exported {exported} readings to {files} files in {out_dir} in {time.perf_counter() - start:.1f}s, last id {last_id}")
+
+if __name__ == "__main__":
+    # Load values from the configuration
+    config = ConfigLoader("config.json")
+    EXPORT_DIR = config.get("export.dir", "output/parquet")
+    EXPORT_CHUNK_SIZE = config.get("export.chunk_size", 100000)
+    EXPORT_COMPRESSION = config.get("export.compression", "zstd")
+
+    # NOTE: environment variables must be sourced in advance
+    SQLITE_DB_NAME = os.environ["SQLITE_DB_NAME"]
+
+    parser = argparse.ArgumentParser(description="Export new sqlite readings to partitioned Parquet files")
+    parser.add_argument("--out", default=EXPORT_DIR, help="export directory")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="readings per read from the database")
+    parser.add_argument("--compression", default=EXPORT_COMPRESSION, help="Parquet compression, e.g. zstd, snappy or none")
+    args = parser.parse_args()
+
+    export(SQLITE_DB_NAME, args.out, args.chunk_size, args.compression)
@@ -1,103 +1,283 @@
 # general
 import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import json
 import xml.etree.ElementTree as ET
 import time
 import re
+import threading
+import gzip
+import zlib
+import queue
+import socket
+import selectors
+import multiprocessing
 # solace
 from solace.messaging.messaging_service import MessagingService, RetryStrategy
 from solace.messaging.resources.topic import Topic
+from solace.messaging.publisher.persistent_message_publisher import MessagePublishReceiptListener
 from solace.messaging.config.transport_security_strategy import TLS
 from solace.messaging.config.authentication_strategy import ClientCertificateAuthentication
 # ez
 from ez_config_loader import ConfigLoader
+from ez_metrics import MetricsRegistry
+from ez_traffic import TrafficWriter
 #from ez_opentelemetry import *
 
 def tprint(string=""):
     """Takes a string and prints it with a timestamp prefixt."""
     print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
 
+# Set in run_gateway when incoming messages are recorded for replay with ez_traffic.py
+traffic_writer = None
+
+# Gateway metrics, served in Prometheus text format on GET /metrics
+metrics = MetricsRegistry()
+STAGE_SECONDS = "gateway_stage_duration_seconds"
+STAGE_HELP = "Time spent per request processing stage"
+read_seconds = metrics.histogram(STAGE_SECONDS, STAGE_HELP, stage="read")
+parse_seconds = metrics.histogram(STAGE_SECONDS, STAGE_HELP, stage="parse")
+json_seconds = metrics.histogram(STAGE_SECONDS, STAGE_HELP, stage="json")
+topic_seconds = metrics.histogram(STAGE_SECONDS, STAGE_HELP, stage="topic")
+publish_seconds = metrics.histogram(STAGE_SECONDS, STAGE_HELP, stage="publish")
+receipt_seconds = metrics.histogram("gateway_publish_receipt_seconds", "Broker round trip of a persistent message")
+readings_total = metrics.counter("gateway_readings_total", "Readings received, batches count every reading")
+errors_total = metrics.counter("gateway_errors_total", "Malformed requests and failed publishes")
+http_in_flight = metrics.gauge("gateway_http_requests_in_flight", "HTTP requests being handled")
+metrics.gauge("gateway_publish_in_flight", "Persistent messages waiting for a broker acknowledgement", callback=lambda: publish_window.in_flight)
+metrics.gauge("gateway_ingestion_queue_depth", "Messages waiting in the ingestion queue", callback=lambda: ingestion_queue.qsize())
+metrics.counter("gateway_ingestion_rejected_total", "Requests rejected with 503 because the ingestion queue was full", callback=lambda: ingestion_queue.rejected)
+
+# Elements read from every SOAP message, precomputed once as (namespace qualified) tag -> field name
+EBXML_NS = 'http://www.oasis-open.org/committees/ebxml-msg/schema/msg-header-2_0.xsd'
+SOAP_FIELDS = {
+    'plant-id': 'plant_id',
+    'building-id': 'building_id',
+    'machine-id': 'machine_id',
+    'Content': 'payload',
+    f'{{{EBXML_NS}}}CPAId': 'cpaid',
+    f'{{{EBXML_NS}}}ConversationId': 'conversationid',
+    f'{{{EBXML_NS}}}Service': 'service',
+    f'{{{EBXML_NS}}}Action': 'action',
+    f'{{{EBXML_NS}}}MessageId': 'messageid',
+    'dli': 'dli',
+    'sri': 'sri',
+    'odi': 'odi'
+}
+SOAP_BODY = '{http://schemas.xmlsoap.org/soap/envelope/}Body'
+CONTENT_PATTERN = re.compile(r"\[(.*?)\] Dust level: (\w+), Sticky residue: (\w+), Odor: (\w+)\. Cleaning: ([\w\s]+)\.")
+
 def extract_soap_data(soap_xml):
-    """Extracts machine-id and body content from SOAP XML."""
+    """Extracts machine-id and body content from SOAP XML in a single pass over the tree.
+
+    Raises ET.ParseError for malformed XML."""
+    root = ET.fromstring(soap_xml)
+    found = {}
+    for element in root.iter():
+        field = SOAP_FIELDS.get(element.tag)
+        # First match in document order wins, same as root.find(".//...")
+        if field is not None and field not in found:
+            found[field] = element.text
+            if len(found) == len(SOAP_FIELDS):
+                break
+    match = CONTENT_PATTERN.search(found['payload'] or "") if 'payload' in found else None
+    if len(found) < len(SOAP_FIELDS) or match is None:
+        # Unexpected document, let the element by element lookup sort it out
+        return extract_soap_fields(root)
+    return soap_fields(found, match)
+
+def soap_fields(found, match):
+    """Orders the found element texts and the Content regex groups into the extract_soap_data tuple."""
     unk = "Unknown"
-    try:
-        root = ET.fromstring(soap_xml)
-        plant_id = root.find(".//plant-id")
-        building_id = root.find(".//building-id")
-        machine_id = root.find(".//machine-id")
-        dli = root.find(".//dli")
-        sri = root.find(".//sri")
-        odi = root.find(".//odi")
-        payload = root.find(".//Content")
-        match = re.search(r"\[(.*?)\] Dust level: (\w+), Sticky residue: (\w+), Odor: (\w+)\. Cleaning: ([\w\s]+)\.", ET.tostring(payload, encoding='unicode'))
-        if match:
-            timestamp, dust, sticky, odor, cleaning = match.groups()
-        else:
-            timestamp, dust, sticky, odor, cleaning = unk
-        # Create dynamic topic using APP_TOPIC as root based on incoming SOAP message properties
-        # Not so ok to have namespsaces and elements hardcoded even though this is a dedicated gateway script...
-        namespaces = {'dt': 'http://www.oasis-open.org/committees/ebxml-msg/schema/msg-header-2_0.xsd'} # add more as needed
-        cpaid = root.find('.//dt:CPAId', namespaces)
-        conversationid = root.find('.//dt:ConversationId', namespaces)
-        service = root.find('.//dt:Service', namespaces)
-        action = root.find('.//dt:Action', namespaces)
-        return (
-            plant_id.text if plant_id is not None else unk,
-            building_id.text if building_id is not None else unk,
-            machine_id.text if machine_id is not None else unk,
-            payload.text if payload is not None else unk,
-            cpaid.text if cpaid is not None else unk,
-            conversationid.text if conversationid is not None else unk,
-            service.text if service is not None else unk,
-            action.text if action is not None else unk,
-            timestamp,
-            dust,
-            sticky,
-            odor,
-            cleaning,
-            dli.text if dli is not None else unk,
-            sri.text if sri is not None else unk,
-            odi.text if odi is not None else unk
-        )
-    except ET.ParseError:
-        return unk, ""
+    timestamp, dust, sticky, odor, cleaning = match.groups() if match else (unk,) * 5
+    return (
+        found.get('plant_id', unk),
+        found.get('building_id', unk),
+        found.get('machine_id', unk),
+        found.get('payload', unk),
+        found.get('cpaid', unk),
+        found.get('conversationid', unk),
+        found.get('service', unk),
+        found.get('action', unk),
+        timestamp,
+        dust,
+        sticky,
+        odor,
+        cleaning,
+        found.get('dli', unk),
+        found.get('sri', unk),
+        found.get('odi', unk),
+        found.get('messageid', unk)
+    )
+
+def extract_soap_batch(soap_xml):
+    """Extracts one extract_soap_data tuple per Payload/Document of a batch SOAP envelope.
+
+    The ebXML header fields are shared by all readings, the ConversationId is made per reading
+    from its plant, building and machine. Raises ET.ParseError for malformed XML."""
+    root = ET.fromstring(soap_xml)
+    header = {}
+    for element in root.iter():
+        if element.tag == SOAP_BODY:
+            break
+        field = SOAP_FIELDS.get(element.tag)
+        if field is not None and field not in header:
+            header[field] = element.text
+    readings = []
+    for document in root.iter('Document'):
+        found = {}
+        for element in document.iter():
+            field = SOAP_FIELDS.get(element.tag)
+            if field is not None and field not in found:
+                found[field] = element.text
+        found.update(header)
+        found['conversationid'] = f"{found.get('plant_id')}/{found.get('building_id')}/{found.get('machine_id')}"
+        if 'messageid' in header:
+            # One MessageId for the envelope, a resent batch gets the same id per reading again
+            found['messageid'] = f"{header['messageid']}/{len(readings)}"
+        match = CONTENT_PATTERN.search(found['payload'] or "") if 'payload' in found else None
+        readings.append(soap_fields(found, match))
+    return readings
+
+def extract_soap_data_legacy(soap_xml):
+    """Extracts machine-id and body content from SOAP XML with a separate tree scan per element.
+
+    Raises ET.ParseError for malformed XML."""
+    return extract_soap_fields(ET.fromstring(soap_xml))
+
+def extract_soap_fields(root):
+    """Looks up every field with its own root.find(".//..."), tolerates missing elements."""
+    unk = "Unknown"
+    plant_id = root.find(".//plant-id")
+    building_id = root.find(".//building-id")
+    machine_id = root.find(".//machine-id")
+    dli = root.find(".//dli")
+    sri = root.find(".//sri")
+    odi = root.find(".//odi")
+    payload = root.find(".//Content")
+    match = re.search(r"\[(.*?)\] Dust level: (\w+), Sticky residue: (\w+), Odor: (\w+)\. Cleaning: ([\w\s]+)\.", ET.tostring(payload, encoding='unicode')) if payload is not None else None
+    if match:
+        timestamp, dust, sticky, odor, cleaning = match.groups()
+    else:
+        timestamp = dust = sticky = odor = cleaning = unk
+    # Create dynamic topic using APP_TOPIC as root based on incoming SOAP message properties
+    # Not so ok to have namespsaces and elements hardcoded even though this is a dedicated gateway script...
+    namespaces = {'dt': EBXML_NS} # add more as needed
+    cpaid = root.find('.//dt:CPAId', namespaces)
+    conversationid = root.find('.//dt:ConversationId', namespaces)
+    service = root.find('.//dt:Service', namespaces)
+    action = root.find('.//dt:Action', namespaces)
+    messageid = root.find('.//dt:MessageId', namespaces)
+    return (
+        plant_id.text if plant_id is not None else unk,
+        building_id.text if building_id is not None else unk,
+        machine_id.text if machine_id is not None else unk,
+        payload.text if payload is not None else unk,
+        cpaid.text if cpaid is not None else unk,
+        conversationid.text if conversationid is not None else unk,
+        service.text if service is not None else unk,
+        action.text if action is not None else unk,
+        timestamp,
+        dust,
+        sticky,
+        odor,
+        cleaning,
+        dli.text if dli is not None else unk,
+        sri.text if sri is not None else unk,
+        odi.text if odi is not None else unk,
+        messageid.text if messageid is not None else unk
+    )
 
 class SOAPRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps machine connections open between requests, every response must carry a Content-Length
+    protocol_version = "HTTP/1.1"
+    # Close idle keep-alive connections so they do not pin a worker thread forever
+    timeout = 5
+    # Headers and body go out in separate writes, without TCP_NODELAY keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_empty(404)
+            return
+        self.send_body(200, "text/plain; version=0.0.4", metrics.render().encode('utf-8'))
+
     def do_POST(self):
+        http_in_flight.inc()
+        try:
+            self.handle_post()
+        finally:
+            http_in_flight.dec()
+
+    def send_response(self, code, message=None):
+        metrics.counter("gateway_responses_total", "HTTP responses sent by status code", code=int(code)).inc()
+        super().send_response(code, message)
+        # An idle keep-alive connection holds a worker thread, give it up when other connections wait for one
+        if self.close_connection or getattr(self.server, "connections_waiting", 0) > 0:
+            self.send_header("Connection", "close")
+
+    def handle_post(self):
+        started = time.perf_counter()
         content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        plant_id, building_id, machine_id, payload, cpaid, conversationid, service, action, timestamp, dust, sticky, odor, cleaning, dli, sri, odi = extract_soap_data(post_data)
-        json_message = json.dumps({
-            "plant_id": plant_id,
-            "building_id": building_id + plant_id,
-            "machine_id": machine_id + building_id + plant_id,
-            "payload": payload,
-            "cpaid": cpaid,
-            "conversationid": conversationid,
-            "service": service,
-            "action": action,
-            "timestamp": timestamp,
-            "dust": dust,
-            "sticky": sticky,
-            "odor": odor,
-            "cleaning": cleaning,
-            "dli": dli,
-            "sri": sri,
-            "odi": odi
-        })
-
-        # NOTE: conversationid now contains combined value of {plant_id}/{building_id}/{machine_id}
-        topic = (
-            f"{APP_TOPIC}/json/v1/"
-            f"{conversationid}/{cpaid}/{service}/{action}/"
-            f"{dust}/{sticky}/{odor}/{cleaning}"
-        )        
-        topic_dest = Topic.of(topic)
-        if publish_to_solace(topic_dest, json_message):
-            self.send_response(200)
-            self.send_header("Content-type", "text/xml")
-            self.end_headers()
+        if content_length > MAX_BODY:
+            # The body is left unread, so this connection cannot be reused
+            errors_total.inc()
+            self.close_connection = True
+            self.send_empty(413)
+            return
+        body = self.rfile.read(content_length)
+        content_encoding = (self.headers.get('Content-Encoding') or 'identity').strip().lower()
+        if content_encoding not in CONTENT_DECODERS:
+            errors_total.inc()
+            self.send_empty(415)
+            return
+        try:
+            post_data = decode_body(body, content_encoding).decode('utf-8')
+        except ValueError:
+            errors_total.inc()
+            self.send_empty(413)
+            return
+        except (zlib.error, EOFError):
+            errors_total.inc()
+            self.send_empty(400)
+            return
+        read_seconds.observe(time.perf_counter() - started)
+        # Shed load before spending any CPU on parsing when the broker cannot keep up
+        if ingestion_queue.full():
+            self.send_overloaded()
+            return
+        if urlparse(self.path).path == "/batch":
+            self.handle_batch(post_data)
+            return
+        readings_total.inc()
+        started = time.perf_counter()
+        try:
+            soap_data = extract_soap_data(post_data)
+        except ET.ParseError:
+            errors_total.inc()
+            self.send_empty(400)
+            return
+        parsed = time.perf_counter()
+        parse_seconds.observe(parsed - started)
+        machine_id, cleaning = soap_data[2], soap_data[12]
+        if traffic_writer is not None:
+            # ConversationId is plant/building/machine, the key needed to replay to the Solace REST API
+            traffic_writer.append(post_data, soap_data[5])
+        json_message = build_json_message(soap_data)
+        built = time.perf_counter()
+        json_seconds.observe(built - parsed)
+        topic_dest = Topic.of(build_topic(soap_data))
+        started = time.perf_counter()
+        topic_seconds.observe(started - built)
+        try:
+            receipt = publish_to_solace(topic_dest, json_message)
+        except queue.Full:
+            self.send_overloaded()
+            return
+        publish_seconds.observe(time.perf_counter() - started)
+        if receipt:
             response_xml = f"""
             <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">
                 <soapenv:Body>
@@ -109,39 +289,423 @@ class SOAPRequestHandler(BaseHTTPRequestHandler):
                 </soapenv:Body>
             </soapenv:Envelope>
             """
-            self.wfile.write(response_xml.encode('utf-8'))
+            self.send_xml(200, response_xml, {"X-Publish-Receipt-Ms": f"{receipt.latency * 1000:.3f}"})
         else:
-            self.send_response(500)
-            self.end_headers()
+            errors_total.inc()
+            self.send_empty(500)
 
-def publish_to_solace(topic, message):
-    """Publishes message to Solace broker using SMF protocol."""
-    try:
-        # Publish message
-        publisher.publish(message, topic)
-        return True
-    except Exception as e:
-        tprint(f"Error publishing to Solace: {e}")
+    def handle_batch(self, post_data):
+        """Publishes every Payload/Document of a batch envelope to its own topic and acknowledges each one."""
+        started = time.perf_counter()
+        try:
+            readings = extract_soap_batch(post_data)
+        except ET.ParseError:
+            errors_total.inc()
+            self.send_empty(400)
+            return
+        parse_seconds.observe(time.perf_counter() - started)
+        if not readings or len(readings) > MAX_BATCH:
+            errors_total.inc()
+            self.send_empty(413 if readings else 400)
+            return
+        readings_total.inc(len(readings))
+        # Queue every reading before waiting, so the whole batch is in flight to the broker at once
+        pendings = []
+        for soap_data in readings:
+            started = time.perf_counter()
+            json_message = build_json_message(soap_data)
+            built = time.perf_counter()
+            json_seconds.observe(built - started)
+            topic_dest = Topic.of(build_topic(soap_data))
+            topic_seconds.observe(time.perf_counter() - built)
+            try:
+                pendings.append(ingestion_queue.submit(topic_dest, json_message))
+            except queue.Full:
+                pendings.append(None)
+        started = time.perf_counter()
+        # One deadline for the whole batch, a stalled broker must not cost a full timeout per reading
+        deadline = time.monotonic() + publish_window.timeout
+        items = []
+        acknowledged = rejected = 0
+        for index, (soap_data, pending) in enumerate(zip(readings, pendings)):
+            if pending is None:
+                status = "rejected"
+                rejected += 1
+            elif wait_for_receipt(pending, deadline - time.monotonic()):
+                status = "acknowledged"
+                acknowledged += 1
+            else:
+                status = "failed"
+                errors_total.inc()
+            items.append(
+                f"""<Item index="{index}"><machine-id>{soap_data[2]}</machine-id>"""
+                f"""<cleaning>{soap_data[12]}</cleaning><Status>{status}</Status></Item>"""
+            )
+        publish_seconds.observe(time.perf_counter() - started)
+        if acknowledged == 0:
+            if rejected:
+                self.send_overloaded()
+            else:
+                self.send_empty(500)
+            return
+        if rejected:
+            ingestion_queue.count_rejected()
+        newline = "\n                        "
+        response_xml = f"""
+            <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">
+                <soapenv:Body>
+                    <Response>
+                        <Message>{acknowledged} of {len(readings)} messages acknowledged</Message>
+                        {newline.join(items)}
+                    </Response>
+                </soapenv:Body>
+            </soapenv:Envelope>
+            """
+        self.send_xml(200, response_xml)
+
+    def send_xml(self, status, response_xml, headers=None):
+        self.send_body(status, "text/xml", response_xml.encode('utf-8'), headers)
+
+    def send_body(self, status, content_type, response_body, headers=None):
+        """Sends a response body, gzip compressed when the client accepts it and it is worth it."""
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        if len(response_body) >= COMPRESS_MIN_BYTES and accepts_gzip(self.headers.get('Accept-Encoding')):
+            response_body = gzip.compress(response_body, compresslevel=6)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(response_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("X-Ingestion-Queue-Depth", str(ingestion_queue.qsize()))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.send_header("X-Ingestion-Queue-Depth", str(ingestion_queue.qsize()))
+        self.end_headers()
+
+    def send_overloaded(self):
+        """Answers 503 with Retry-After so machines back off instead of piling up requests."""
+        ingestion_queue.count_rejected()
+        self.send_response(503)
+        self.send_header("Retry-After", str(RETRY_AFTER))
+        self.send_header("Content-Length", "0")
+        self.send_header("X-Ingestion-Queue-Depth", str(ingestion_queue.qsize()))
+        self.end_headers()
+
+# Responses smaller than this are not worth the gzip header and CPU
+COMPRESS_MIN_BYTES = 256
+# Supported request Content-Encoding values and their zlib wbits
+CONTENT_DECODERS = {
+    'identity': None,
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+def decode_body(body, content_encoding):
+    """Decompresses a gzip or deflate request body, raises ValueError when it inflates beyond MAX_BODY bytes."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    wbits = CONTENT_DECODERS[encoding]
+    if wbits is None:
+        return body
+    if encoding == 'deflate' and body[:1] != b'\x78':
+        # Some clients send raw deflate without the zlib header
+        wbits = -zlib.MAX_WBITS
+    decompressor = zlib.decompressobj(wbits)
+    decoded = decompressor.decompress(body, MAX_BODY)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Decompressed body larger than {MAX_BODY} bytes")
+    if not decompressor.eof:
+        raise EOFError("Truncated compressed body")
+    return decoded
+
+def accepts_gzip(accept_encoding):
+    """True when the Accept-Encoding header allows gzip (and does not set its q to 0)."""
+    if not accept_encoding:
         return False
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip', '*'):
+            return params.replace(' ', '').lower() not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
 
-if __name__ == "__main__":
-    # Load values from the configuration
-    config = ConfigLoader("config.json")
-    APP_TOPIC = config.get("app.topic")
-    # Only print, write etc in debug modus, using config variable
-    APP_DEBUG = config.get("app.debug")
+def build_json_message(soap_data):
+    """Converts an extract_soap_data tuple to the JSON message published to the broker."""
+    plant_id, building_id, machine_id, payload, cpaid, conversationid, service, action, timestamp, dust, sticky, odor, cleaning, dli, sri, odi, messageid = soap_data
+    return json.dumps({
+        "plant_id": plant_id,
+        "building_id": building_id + plant_id,
+        "machine_id": machine_id + building_id + plant_id,
+        "payload": payload,
+        "cpaid": cpaid,
+        "conversationid": conversationid,
+        "service": service,
+        "action": action,
+        "timestamp": timestamp,
+        "dust": dust,
+        "sticky": sticky,
+        "odor": odor,
+        "cleaning": cleaning,
+        "dli": dli,
+        "sri": sri,
+        "odi": odi,
+        # Subscribers drop a redelivered or resent reading by its ebXML MessageId
+        "messageid": messageid
+    })
 
-    # NOTE: environment variables must be sourced in advance
-    # Solace broker connection settings
-    SOLACE_MESSAGE_VPN = os.environ["SOLACE_MESSAGE_VPN"]
-    SOLACE_CLIENT_USER = os.environ["SOLACE_CLIENT_USER"]
-    SOLACE_CLIENT_PASS = os.environ["SOLACE_CLIENT_PASS"]
-    SOLACE_HOST = os.environ["SOLACE_HOST"]
-    SOLACE_SMF_PORT = os.environ["SOLACE_SMF_PORT"]
-    SOLACE_TRUSTSTORE_PEM = os.environ["SOLACE_TRUSTSTORE_PEM"]
+def build_topic(soap_data):
+    """Creates the dynamic topic using APP_TOPIC as root based on the incoming SOAP message properties."""
+    plant_id, building_id, machine_id, payload, cpaid, conversationid, service, action, timestamp, dust, sticky, odor, cleaning, dli, sri, odi, messageid = soap_data
+    # NOTE: conversationid now contains combined value of {plant_id}/{building_id}/{machine_id}
+    return (
+        f"{APP_TOPIC}/json/v1/"
+        f"{conversationid}/{cpaid}/{service}/{action}/"
+        f"{dust}/{sticky}/{odor}/{cleaning}"
+    )
 
-    SOLACE_TCP_PROTOCOL = os.environ["SOLACE_TCP_PROTOCOL"]
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that handles each connection on a fixed size pool of worker threads."""
+    # Machines connect in bursts, allow a longer listen backlog than the socketserver default of 5
+    request_queue_size = 1024
+    # Seconds a rejected connection is read from before it is closed, and at most this many at once
+    reject_linger = 1
+    max_lingering = 1024
+
+    def __init__(self, server_address, RequestHandlerClass, workers=32, bind_and_activate=True, max_waiting=256):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gateway")
+        self.lock = threading.Lock()
+        # Accepted connections not yet picked up by a worker thread, beyond max_waiting they are answered 503 right away
+        self.connections_waiting = 0
+        self.max_waiting = max_waiting
+        # Rejected connections are closed on their own thread, the accepting thread never waits for a client
+        self.rejected = queue.Queue()
+        threading.Thread(target=self.close_rejected, name="gateway-reject", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            overloaded = self.max_waiting and self.connections_waiting >= self.max_waiting
+            if not overloaded:
+                self.connections_waiting += 1
+        if overloaded:
+            # Every worker is busy waiting for receipts, the executor's work queue would grow without bound
+            self.reject_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
 
+    def reject_request(self, request):
+        """Answers 503 with Retry-After on the accepting thread, without reading the request.
+
+        Nothing here blocks, under overload a wait per rejected connection would hold up the accepts."""
+        ingestion_queue.count_rejected()
+        try:
+            request.setblocking(False)
+            # A fresh socket's send buffer takes the short response whole
+            request.send(f"HTTP/1.1 503 Service Unavailable\r\nRetry-After: {RETRY_AFTER}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode('ascii'))
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_request(request)
+            return
+        self.rejected.put(request)
+
+    def close_rejected(self):
+        """Reads the rest of each rejected request and closes the connection once the client closed it or after reject_linger.
+
+        Closing with unread data resets the connection, the client would get an error instead of the 503."""
+        selector = selectors.DefaultSelector()
+        deadlines = {}
+        while True:
+            try:
+                # Only block for the next rejected connection while none is lingering
+                request = self.rejected.get(block=not deadlines)
+                if len(deadlines) < self.max_lingering:
+                    selector.register(request, selectors.EVENT_READ)
+                    deadlines[request] = time.monotonic() + self.reject_linger
+                else:
+                    self.close_request(request)
+            except queue.Empty:
+                pass
+            for key, _ in selector.select(timeout=0 if not self.rejected.empty() else 0.05):
+                try:
+                    if key.fileobj.recv(65536):
+                        continue
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    pass
+                # Closed by the client or failed, close it now
+                deadlines[key.fileobj] = 0
+            now = time.monotonic()
+            for request in [request for request, deadline in deadlines.items() if deadline <= now]:
+                selector.unregister(request)
+                del deadlines[request]
+                self.close_request(request)
+
+    def process_request_thread(self, request, client_address):
+        with self.lock:
+            self.connections_waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+class PendingPublish:
+    """A published message waiting for its broker acknowledgement."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.done = threading.Event()
+        self.persisted = False
+        self.error = None
+        self.latency = None
+        self.cancelled = False
+
+    def complete(self, persisted, error=None):
+        self.latency = time.perf_counter() - self.started
+        self.persisted = persisted
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout):
+        """Returns True when the broker acknowledged the message within timeout seconds."""
+        return self.done.wait(timeout) and self.persisted
+
+class PublishWindow(MessagePublishReceiptListener):
+    """Keeps up to size persistent messages in flight and correlates broker receipts to the waiting requests."""
+    def __init__(self, publisher, size=256, timeout=10):
+        self.publisher = publisher
+        self.size = size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.receipts = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        publisher.set_message_publish_receipt_listener(self)
+
+    def publish(self, message, topic, pending=None):
+        """Publishes without waiting for the broker, returns a PendingPublish to wait on."""
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"publish window of {self.size} messages still full after {self.timeout}s")
+        if pending is None:
+            pending = PendingPublish()
+        # Receipt latency covers the broker round trip only, not the time spent in the ingestion queue
+        pending.started = time.perf_counter()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            self.publisher.publish(message, topic, user_context=pending)
+        except Exception:
+            self.release()
+            raise
+        return pending
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def on_publish_receipt(self, publish_receipt):
+        """Called on the Solace API thread for every acknowledged (or rejected) persistent message."""
+        pending = publish_receipt.user_context
+        if pending is None:
+            return
+        self.release()
+        pending.complete(publish_receipt.is_persisted and publish_receipt.exception is None, publish_receipt.exception)
+        receipt_seconds.observe(pending.latency)
+        with self.lock:
+            self.receipts += 1
+            self.latency_total += pending.latency
+            self.latency_max = max(self.latency_max, pending.latency)
+            if not pending.persisted:
+                self.failures += 1
+
+    def stats(self):
+        """Returns in flight count, receipts, failures and average/max publish receipt latency in ms."""
+        with self.lock:
+            average = self.latency_total / self.receipts if self.receipts else 0.0
+            return {
+                "in_flight": self.in_flight,
+                "receipts": self.receipts,
+                "failures": self.failures,
+                "latency_avg_ms": round(average * 1000, 3),
+                "latency_max_ms": round(self.latency_max * 1000, 3)
+            }
+
+class IngestionQueue:
+    """Bounded stage between HTTP parsing and publishing, requests are rejected when it is full."""
+    def __init__(self, window, depth=1000):
+        self.window = window
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.lock = threading.Lock()
+        self.rejected = 0
+        threading.Thread(target=self.run, name="ingestion", daemon=True).start()
+
+    def submit(self, topic, message):
+        """Queues a message for publishing, raises queue.Full instead of waiting when the gateway is overloaded."""
+        pending = PendingPublish()
+        self.queue.put_nowait((topic, message, pending))
+        return pending
+
+    def full(self):
+        return self.queue.full()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def count_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def run(self):
+        """Hands queued messages to the publish window, blocks while the window is full."""
+        while True:
+            topic, message, pending = self.queue.get()
+            # The request already gave up waiting, do not publish a message the machine will send again
+            if pending.cancelled:
+                continue
+            try:
+                self.window.publish(message, topic, pending)
+            except Exception as e:
+                pending.complete(False, e)
+
+def publish_to_solace(topic, message):
+    """Publishes message to Solace broker using SMF protocol, returns the acknowledged PendingPublish or None.
+
+    Raises queue.Full when the ingestion queue has no room for the message."""
+    pending = ingestion_queue.submit(topic, message)
+    return wait_for_receipt(pending)
+
+def wait_for_receipt(pending, timeout=None):
+    """Waits for the broker acknowledgement of a queued message, returns pending when persisted or None.
+
+    timeout defaults to the publish window timeout, pass the time left when waiting for several messages."""
+    if pending.wait(publish_window.timeout if timeout is None else max(0, timeout)):
+        return pending
+    pending.cancelled = True
+    tprint(f"Error publishing to Solace: {pending.error or 'no broker acknowledgement in time'}")
+    return None
+
+def report_publish_stats(interval):
+    """Periodically prints publish receipt latency, only in debug modus."""
+    while True:
+        time.sleep(interval)
+        tprint(f"Publish window: {publish_window.stats()}, ingestion queue depth: {ingestion_queue.qsize()}/{ingestion_queue.depth}, rejected: {ingestion_queue.rejected}")
+
+def connect_messaging_service():
+    """Builds the Solace messaging service from the broker settings and connects it."""
     broker_props = {
         "solace.messaging.transport.host": f"{SOLACE_TCP_PROTOCOL}{SOLACE_HOST}:{SOLACE_SMF_PORT}",
         "solace.messaging.service.vpn-name": SOLACE_MESSAGE_VPN,
@@ -173,18 +737,134 @@ if __name__ == "__main__":
     messaging_service.connect()
     tprint("Connect to Solace broker...")
     tprint()
+    return messaging_service
+
+def start_publisher(messaging_service):
+    """Creates the persistent publisher with its publish window and ingestion queue."""
+    global publisher, publish_window, ingestion_queue
     # Create publisher
     publisher = messaging_service.create_persistent_message_publisher_builder().build()
     publisher.start()
+    publish_window = PublishWindow(publisher, PUBLISH_WINDOW, PUBLISH_TIMEOUT)
+    ingestion_queue = IngestionQueue(publish_window, QUEUE_DEPTH)
     tprint("Pubsliher started...")
     tprint()
+    if APP_DEBUG:
+        threading.Thread(target=report_publish_stats, args=(60,), daemon=True).start()
 
+def create_http_server(listen_socket=None):
+    """Creates the gateway HTTP server, on listen_socket when it is shared with other worker processes."""
+    server_address = (GATEWAY_HOST, GATEWAY_PORT)
+    if GATEWAY_MODE == "threaded":
+        httpd = ThreadPoolHTTPServer(server_address, SOAPRequestHandler, GATEWAY_WORKERS, bind_and_activate=listen_socket is None, max_waiting=MAX_WAITING)
+    else:
+        # One request at a time, keep-alive would block every other machine
+        SOAPRequestHandler.protocol_version = "HTTP/1.0"
+        httpd = HTTPServer(server_address, SOAPRequestHandler, bind_and_activate=listen_socket is None)
+    if listen_socket is not None:
+        httpd.socket.close()
+        httpd.socket = listen_socket
+        httpd.server_address = listen_socket.getsockname()
+        httpd.server_name = socket.getfqdn(GATEWAY_HOST)
+        httpd.server_port = GATEWAY_PORT
+    return httpd
+
+def run_gateway(listen_socket=None):
+    """Connects to the broker and serves HTTP, runs in the main process or in every worker process."""
+    global traffic_writer
+    if RECORD_DIR:
+        # A file per process, worker processes must not append to the same file
+        traffic_writer = TrafficWriter(os.path.join(RECORD_DIR, f"gateway-{os.getpid()}.ezt"))
+        tprint(f"Recording incoming messages to {traffic_writer.path}")
+    messaging_service = connect_messaging_service()
+    start_publisher(messaging_service)
     # Start HTTP server
     try:
-        tprint("Gateway HTTP server on port 54321 started")
-        server_address = ('localhost', 54321)
-        httpd = HTTPServer(server_address, SOAPRequestHandler)
+        httpd = create_http_server(listen_socket)
+        workers = f" with {GATEWAY_WORKERS} workers" if GATEWAY_MODE == "threaded" else ""
+        tprint(f"Gateway HTTP server on port {GATEWAY_PORT} started{workers} (pid {os.getpid()})")
         httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         tprint(f"Gateway HTTP server not started: {e}")
         quit()
+    finally:
+        publisher.terminate()
+        messaging_service.disconnect()
+
+def supervise_workers(processes):
+    """Pre-fork master: binds the port once, runs a gateway worker process per core and restarts dead workers."""
+    listen_socket = socket.create_server((GATEWAY_HOST, GATEWAY_PORT), backlog=ThreadPoolHTTPServer.request_queue_size)
+    # Fork so the workers inherit the listening socket and the configuration loaded in __main__,
+    # the master itself never connects to the broker so there is no Solace session to inherit
+    context = multiprocessing.get_context("fork")
+    workers = {}
+
+    def start_worker(index):
+        worker = context.Process(target=run_gateway, args=(listen_socket,), name=f"gateway-{index}")
+        worker.start()
+        workers[index] = worker
+
+    for index in range(processes):
+        start_worker(index)
+    tprint(f"Gateway master on port {GATEWAY_PORT} started {processes} worker processes")
+    try:
+        while True:
+            time.sleep(1)
+            for index, worker in list(workers.items()):
+                if not worker.is_alive():
+                    tprint(f"Gateway worker {index} (pid {worker.pid}) exited with code {worker.exitcode}, restarting")
+                    start_worker(index)
+    except KeyboardInterrupt:
+        tprint("Shutting down...")
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.join()
+        listen_socket.close()
+
+if __name__ == "__main__":
+    # Load values from the configuration
+    config = ConfigLoader("config.json")
+    APP_TOPIC = config.get("app.topic")
+    # Only print, write etc in debug modus, using config variable
+    APP_DEBUG = config.get("app.debug")
+    # Gateway HTTP server settings, mode 'single' handles one request at a time, 'threaded' uses a worker pool
+    GATEWAY_HOST = config.get("gateway.host", "localhost")
+    GATEWAY_PORT = config.get("gateway.port", 54321)
+    GATEWAY_MODE = config.get("gateway.mode", "threaded")
+    GATEWAY_WORKERS = config.get("gateway.workers", 32)
+    # Worker processes sharing the port, each with its own broker session and publisher, 1 runs in-process
+    GATEWAY_PROCESSES = config.get("gateway.processes", 1)
+    SOAPRequestHandler.timeout = config.get("gateway.keepalive_timeout", SOAPRequestHandler.timeout)
+    # Number of unacknowledged persistent messages in flight and how long a request waits for its ack
+    PUBLISH_WINDOW = config.get("gateway.publish_window", 256)
+    PUBLISH_TIMEOUT = config.get("gateway.publish_timeout", 10)
+    # Messages waiting to be published before requests are rejected with 503, and the Retry-After seconds sent along
+    QUEUE_DEPTH = config.get("gateway.queue_depth", 1000)
+    RETRY_AFTER = config.get("gateway.retry_after", 1)
+    # Accepted connections waiting for a free worker before new ones are answered 503, 0 waits without limit
+    MAX_WAITING = config.get("gateway.max_waiting", 256)
+    # Most readings accepted in one POST to /batch
+    MAX_BATCH = config.get("gateway.max_batch", 500)
+    # Largest request body accepted, before and after decompression
+    MAX_BODY = config.get("gateway.max_body", 10485760)
+    # Directory to record incoming single messages to, empty to not record
+    RECORD_DIR = config.get("gateway.record_dir", "")
+
+    # NOTE: environment variables must be sourced in advance
+    # Solace broker connection settings
+    SOLACE_MESSAGE_VPN = os.environ["SOLACE_MESSAGE_VPN"]
+    SOLACE_CLIENT_USER = os.environ["SOLACE_CLIENT_USER"]
+    SOLACE_CLIENT_PASS = os.environ["SOLACE_CLIENT_PASS"]
+    SOLACE_HOST = os.environ["SOLACE_HOST"]
+    SOLACE_SMF_PORT = os.environ["SOLACE_SMF_PORT"]
+    SOLACE_TRUSTSTORE_PEM = os.environ["SOLACE_TRUSTSTORE_PEM"]
+
+    SOLACE_TCP_PROTOCOL = os.environ["SOLACE_TCP_PROTOCOL"]
+
+    if GATEWAY_PROCESSES > 1:
+        supervise_workers(GATEWAY_PROCESSES)
+    else:
+        run_gateway()
@@ -0,0 +1,55 @@
+# general
+import os
+import socket
+import time
+
+class Lease:
+    """Named, time-limited lease in the leases table of a sqlite database.
+
+    Several subscriber processes can write the same database, periodic jobs like the analysis and
+    retention should run in only one of them. Whoever holds the lease renews it, any other process
+    takes it over once it is ttl seconds old, so a stopped leader is replaced within ttl. position is
+    the leader's progress, e.g. the last analyzed id, kept with the lease so a new leader continues
+    from there."""
+    def __init__(self, conn, name, ttl=30, owner=None):
+        self.conn = conn
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        self.held = False
+        self.checked = 0
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL, position INTEGER)")
+
+    def acquire(self):
+        """Takes or renews the lease, True while this process holds it. Checks the table at most every ttl / 3 seconds."""
+        now = time.time()
+        if now - self.checked < self.ttl / 3:
+            return self.held
+        with self.conn:
+            # The WHERE keeps the row of a live lease held by another process as it is
+            self.conn.execute('''
+                INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+                WHERE leases.owner = excluded.owner OR leases.expires < ?
+            ''', (self.name, self.owner, now + self.ttl, now))
+            owner = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (self.name,)).fetchone()[0]
+        self.held = owner == self.owner
+        # Renewed a third of the way, so a held lease always has two thirds of ttl left
+        self.checked = now
+        return self.held
+
+    def position(self):
+        return self.conn.execute("SELECT position FROM leases WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def advance(self, position):
+        """Stores the progress, only while this process still holds the lease."""
+        with self.conn:
+            self.conn.execute("UPDATE leases SET position = ? WHERE name = ? AND owner = ?", (position, self.name, self.owner))
+
+    def release(self):
+        """Lets another process take over right away instead of after ttl."""
+        if self.held:
+            with self.conn:
+                self.conn.execute("UPDATE leases SET expires = 0 WHERE name = ? AND owner = ?", (self.name, self.owner))
+            self.held = False
@@ -3,10 +3,14 @@ import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import requests
 import uuid
+import gzip
 import random
 import datetime
 import time
 import threading
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 # ez
 from ez_config_loader import ConfigLoader
@@ -18,14 +22,27 @@ def tprint(string=""):
 def generate_uuid():
     return str(uuid.uuid4())
 
+CPA_IDS = ['cpa123456', 'cpa23456', 'cpa86420', 'cpa98765']
+SERVICES = ['urn:services:SupplierOrderProcessing', 'urn:services:QuoteToCollect']
+ACTIONS = ['NewPurchaseOrder', 'NewOrder', 'PurchaseOrderResponse']
+# Reading levels with their index value and draw weight
+DUST_LEVELS = {'low': (20, 60), 'moderate': (80, 30), 'high': (120, 10)}
+STICKY_LEVELS = {'minimal': (30, 50), 'present': (70, 35), 'excessive': (110, 15)}
+ODOR_LEVELS = {'normal': (10, 70), 'noticeable': (60, 20), 'strong': (100, 10)}
+
 def getCPA():
-    return random.choice(['cpa123456', 'cpa23456', 'cpa86420', 'cpa98765'])
+    return random.choice(CPA_IDS)
 def getService():
-    return random.choice(['urn:services:SupplierOrderProcessing', 'urn:services:QuoteToCollect'])
+    return random.choice(SERVICES)
 def getAction():
-    return random.choice(['NewPurchaseOrder', 'NewOrder', 'PurchaseOrderResponse'])
+    return random.choice(ACTIONS)
+
+def cleaning_advice(dli, sri, odi):
+    # TODO: maintenance calculation should be done in gateway, not in sender...
+    w = dli + sri + odi
+    return 'not required' if w<70 else 'recommended' if w<=150 else 'urgently needed'
 
-def create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, odi):
+def create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, odi, cpaid=None, service=None, action=None, message_id=None, timestamp=None):
     # Define the SOAP envelope with headers and payload
     soap_env = f'''
     <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
@@ -38,13 +55,13 @@ def create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, od
                 <dt:To>
                     <dt:PartyId>urn:example:receiver</dt:PartyId>
                 </dt:To>
-                <dt:CPAId>{getCPA()}</dt:CPAId>
+                <dt:CPAId>{cpaid or getCPA()}</dt:CPAId>
                 <dt:ConversationId>{plant_id}/{building_id}/{machine_id}</dt:ConversationId>
-                <dt:Service>{getService()}</dt:Service>
-                <dt:Action>{getAction()}</dt:Action>
+                <dt:Service>{service or getService()}</dt:Service>
+                <dt:Action>{action or getAction()}</dt:Action>
                 <dt:MessageData>
-                    <dt:MessageId>{generate_uuid()}</dt:MessageId>
-                    <dt:Timestamp>{datetime.datetime.now().isoformat()}</dt:Timestamp>
+                    <dt:MessageId>{message_id or generate_uuid()}</dt:MessageId>
+                    <dt:Timestamp>{timestamp or datetime.datetime.now().isoformat()}</dt:Timestamp>
                 </dt:MessageData>
             </dt:MessageHeader>
         </soapenv:Header>
@@ -68,14 +85,20 @@ def create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, od
     '''
     return soap_env
 
-def send_message(url, message, machine_id):
+def send_message(url, message, machine_id, compress=False, session=None):
     headers = {
         'Content-Type': 'text/xml; charset=utf-8',
         'SOAPAction': 'ebMS',
         'machine-id': machine_id
     }
+    data = message.encode('utf-8') if isinstance(message, str) else message
+    if compress:
+        # Only for the gateway, the Solace REST API would store the compressed bytes as the payload
+        data = gzip.compress(data, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
     try:
-        response = requests.post(url, data=message, headers=headers, timeout=10)
+        # A session reuses its keep-alive connection, without one every call opens a new connection
+        response = (session or requests).post(url, data=data, headers=headers, timeout=10)
         response.raise_for_status()
         return response
     except requests.exceptions.ConnectionError as e:
@@ -106,26 +129,88 @@ class SOAPRequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(response)
         tprint(query_params)
 
-def main():
-    # TODO: get ranges from config.json
-    plant_id = 'plant' + str(random.randint(1, 3)) # 1-5
-    building_id = 'building' + str(random.randint(1, 2)) # 1-20
-    machine_id = 'machine' + str(random.randint(1, 4)) # 1-10
-    d={'low':20,'moderate':80,'high':120}
-    s={'minimal':30,'present':70,'excessive':110}
-    o={'normal':10,'noticeable':60,'strong':100}
-    dl = random.choices(list(d),weights=[60,30,10])[0]
-    dli = d[dl]
-    sr = random.choices(list(s),weights=[50,35,15])[0]
-    sri = s[sr]
-    od = random.choices(list(o),weights=[70,20,10])[0]
-    odi = o[od]
-    # TODO: maintenance calculation should be done in gateway, not in sender...
-    w=d[dl]+s[sr]+o[od]
-    m='not required' if w<70 else 'recommended' if w<=150 else 'urgently needed'
+def create_reading(plant_id, building_id, machine_id):
+    """Creates a SOAP message with random dust, sticky residue and odor levels for one machine."""
+    dl = random.choices(list(DUST_LEVELS),weights=[w for _, w in DUST_LEVELS.values()])[0]
+    dli = DUST_LEVELS[dl][0]
+    sr = random.choices(list(STICKY_LEVELS),weights=[w for _, w in STICKY_LEVELS.values()])[0]
+    sri = STICKY_LEVELS[sr][0]
+    od = random.choices(list(ODOR_LEVELS),weights=[w for _, w in ODOR_LEVELS.values()])[0]
+    odi = ODOR_LEVELS[od][0]
+    m = cleaning_advice(dli, sri, odi)
     payload = f"[{datetime.datetime.now().isoformat()}] Dust level: {dl}, Sticky residue: {sr}, Odor: {od}. Cleaning: {m}."
-    soap_message = create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, odi)
-    response = send_message(APP_URL, soap_message, machine_id)
+    return create_soap_message(plant_id, building_id, machine_id, payload, dli, sri, odi)
+
+class SoapTemplate:
+    """create_soap_message split once into constant envelope bytes around its variable slots.
+
+    generate() draws the random fields for a whole batch of readings at once and only joins
+    pre-encoded bytes per message, instead of formatting the full envelope every time."""
+    SLOTS = ('plant_id', 'building_id', 'machine_id', 'payload', 'dli', 'sri', 'odi', 'cpaid', 'service', 'action', 'message_id', 'timestamp')
+
+    def __init__(self):
+        # Render the envelope with a marker per slot and split on the markers
+        markers = {slot: f"\x00{slot}\x00" for slot in self.SLOTS}
+        parts = create_soap_message(**markers).split("\x00")
+        # One bytes format with a %b per slot occurrence, filled in a single C-level operation
+        self.format = b"%b".join(part.encode('utf-8').replace(b"%", b"%%") for part in parts[0::2])
+        self.order = [self.SLOTS.index(slot) for slot in parts[1::2]]
+        # Every CPA/service/action combination, drawn uniformly like getCPA, getService and getAction
+        self.headers = [tuple(value.encode('utf-8') for value in combination) for combination in itertools.product(CPA_IDS, SERVICES, ACTIONS)]
+        self.encoded = {}
+        # Every dust/sticky/odor combination with its payload text after the timestamp and index values
+        self.readings = []
+        weights = []
+        for dl, (dli, dw) in DUST_LEVELS.items():
+            for sr, (sri, sw) in STICKY_LEVELS.items():
+                for od, (odi, ow) in ODOR_LEVELS.items():
+                    text = f"] Dust level: {dl}, Sticky residue: {sr}, Odor: {od}. Cleaning: {cleaning_advice(dli, sri, odi)}."
+                    self.readings.append((text.encode('utf-8'), str(dli).encode(), str(sri).encode(), str(odi).encode()))
+                    weights.append(dw * sw * ow)
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def render(self, values):
+        """Fills the envelope with the encoded slot values, given in SLOTS order."""
+        return self.format % tuple([values[index] for index in self.order])
+
+    def generate(self, machines, count=None, timestamps=None):
+        """Returns count (plant_id, building_id, machine_id, soap bytes) readings for random machines.
+
+        machines is a list of (plant_id, building_id, machine_id) strings, without count there is
+        one reading for each of them in order. timestamps gives the time of each reading in epoch
+        seconds, e.g. its capture or send time, without it all readings get the current time."""
+        if count is None:
+            picks, count = machines, len(machines)
+        else:
+            picks = random.choices(machines, k=count)
+        readings = random.choices(self.readings, cum_weights=self.cum_weights, k=count)
+        headers = random.choices(self.headers, k=count)
+        # One draw for all message ids, formatted as version 4 UUIDs
+        ids = f"{random.getrandbits(128 * count):0{32 * count}x}"
+        if timestamps is None:
+            # Generated at once, a batch takes well under a millisecond
+            stamps = [datetime.datetime.now().isoformat().encode()] * count
+        else:
+            stamps = [datetime.datetime.fromtimestamp(timestamp).isoformat().encode() for timestamp in timestamps]
+        batch = []
+        for i in range(count):
+            machine = picks[i]
+            encoded = self.encoded.get(machine)
+            if encoded is None:
+                encoded = self.encoded[machine] = tuple(value.encode('utf-8') for value in machine)
+            text, dli, sri, odi = readings[i]
+            h = ids[32 * i:32 * i + 32]
+            message_id = f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{'89ab'[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}".encode()
+            values = encoded + (b"[" + stamps[i] + text, dli, sri, odi) + headers[i] + (message_id, stamps[i])
+            batch.append(machine + (self.render(values),))
+        return batch
+
+def main():
+    plant_id = 'plant' + str(random.randint(1, MACHINE_PLANTS))
+    building_id = 'building' + str(random.randint(1, MACHINE_BUILDINGS))
+    machine_id = 'machine' + str(random.randint(1, MACHINE_MACHINES))
+    soap_message = create_reading(plant_id, building_id, machine_id)
+    response = send_message(APP_URL, soap_message, machine_id, MACHINE_COMPRESS)
     if response:
         tprint(f"SOAP request sent to Gateway {APP_URL}")
         # tprint("Gateway Response:")
@@ -134,6 +219,8 @@ def main():
         # tprint(f"Response text: {response.text}")
     else:
         tprint("Failed to send SOAP message to gateway.")
+    if not MACHINE_REST:
+        return
     url = f"{SOLACE_REST_URL}/{APP_TOPIC}/xml/v1/{plant_id}/{building_id}/{machine_id}"
     response = send_message(url, soap_message, machine_id)
     if response:
@@ -145,10 +232,102 @@ def main():
     else:
         tprint("Failed to send SOAP message to Solace broker.")
 
+class Fleet:
+    """Simulates every configured machine sending a reading each interval, like a real factory floor."""
+    def __init__(self, plants, buildings, machines, interval, jitter=0.1, workers=64, send_rest=True):
+        self.machines = [
+            (f'plant{p}', f'building{b}', f'machine{m}')
+            for p in range(1, plants + 1)
+            for b in range(1, buildings + 1)
+            for m in range(1, machines + 1)
+        ]
+        self.template = SoapTemplate()
+        self.interval = interval
+        self.jitter = jitter
+        self.send_rest = send_rest
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fleet")
+        # Bounds the readings waiting for a sender, the scheduler falls behind instead of queueing without limit
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.lag_max = 0.0
+
+    def session(self):
+        """One keep-alive session per sender thread, requests sessions are not thread-safe."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            # One connection to the gateway and one to the Solace REST API
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return session
+
+    def send(self, plant_id, building_id, machine_id):
+        try:
+            soap_message = self.template.generate([(plant_id, building_id, machine_id)])[0][3]
+            session = self.session()
+            ok = send_message(APP_URL, soap_message, machine_id, MACHINE_COMPRESS, session) is not None
+            if self.send_rest:
+                url = f"{SOLACE_REST_URL}/{APP_TOPIC}/xml/v1/{plant_id}/{building_id}/{machine_id}"
+                ok = send_message(url, soap_message, machine_id, session=session) is not None and ok
+            with self.lock:
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+        finally:
+            self.slots.release()
+
+    def run(self):
+        """Schedules every machine on its own interval, starting at a random offset to spread the load."""
+        now = time.monotonic()
+        schedule = [(now + random.uniform(0, self.interval), index) for index in range(len(self.machines))]
+        heapq.heapify(schedule)
+        while True:
+            due, index = heapq.heappop(schedule)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.slots.acquire()
+            lag = time.monotonic() - due
+            if lag > self.lag_max:
+                self.lag_max = lag
+            self.executor.submit(self.send, *self.machines[index])
+            heapq.heappush(schedule, (due + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter), index))
+
+    def report(self, every=10):
+        """Prints sent and failed readings per interval instead of a line per message."""
+        while True:
+            time.sleep(every)
+            with self.lock:
+                sent, failed, lag_max = self.sent, self.failed, self.lag_max
+                self.sent = self.failed = 0
+                self.lag_max = 0.0
+            tprint(f"Fleet of {len(self.machines)} machines: {sent / every:.1f} readings/s sent, {failed} failed, max schedule lag {lag_max * 1000:.0f} ms")
+
+def get_solace_rest_url():
+    """Builds the Solace REST API URL from the broker connection settings."""
+    # NOTE: environment variables must be sourced in advance
+    # Solace broker connection settings
+    SOLACE_CLIENT_USER = os.environ["SOLACE_CLIENT_USER"]
+    SOLACE_CLIENT_PASS = os.environ["SOLACE_CLIENT_PASS"]
+    SOLACE_HOST = os.environ["SOLACE_HOST"]
+    SOLACE_REST_PORT = os.environ["SOLACE_REST_PORT"]
+
+    http_protocol = 'https://' if SOLACE_REST_PORT[-2:] == '43' else 'http://'
+
+    userpass = '' if http_protocol == 'http://' else f"{SOLACE_CLIENT_USER}:{SOLACE_CLIENT_PASS}@" # TODO: sloppy... replace with proper check/setup (as in other repo)
+
+    return f"{http_protocol}{userpass}{SOLACE_HOST}:{SOLACE_REST_PORT}"
+
 def run_loop():
     while True:
         main()
-        time.sleep(5)  # Interval between messages
+        time.sleep(MACHINE_INTERVAL)  # Interval between messages
 
 def run_http_server():
     try:
@@ -165,25 +344,33 @@ if __name__ == "__main__":
     config = ConfigLoader("config.json")
     APP_URL = config.get("app.url")
     APP_TOPIC = config.get("app.topic")
-
-    # NOTE: environment variables must be sourced in advance
-    # Solace broker connection settings
-    SOLACE_MESSAGE_VPN = os.environ["SOLACE_MESSAGE_VPN"]
-    SOLACE_CLIENT_USER = os.environ["SOLACE_CLIENT_USER"]
-    SOLACE_CLIENT_PASS = os.environ["SOLACE_CLIENT_PASS"]
-    SOLACE_HOST = os.environ["SOLACE_HOST"]
-    SOLACE_REST_PORT = os.environ["SOLACE_REST_PORT"]
-
-    http_protocol = 'https://' if SOLACE_REST_PORT[-2:] == '43' else 'http://'
-
-    userpass = '' if http_protocol == 'http://' else f"{SOLACE_CLIENT_USER}:{SOLACE_CLIENT_PASS}@" # TODO: sloppy... replace with proper check/setup (as in other repo)
+    # Gzip compress the SOAP messages sent to the gateway
+    MACHINE_COMPRESS = config.get("machine.compress", False)
+    # Also send every message directly to the Solace REST API
+    MACHINE_REST = config.get("machine.rest", True)
+    # Number of plants, buildings per plant and machines per building, and seconds between messages
+    MACHINE_PLANTS = config.get("machine.plants", 3)
+    MACHINE_BUILDINGS = config.get("machine.buildings", 2)
+    MACHINE_MACHINES = config.get("machine.machines", 4)
+    MACHINE_INTERVAL = config.get("machine.interval", 5)
+    # Fleet mode: every machine sends each interval (+/- jitter fraction) using a pool of sender threads
+    MACHINE_FLEET = config.get("machine.fleet", False)
+    MACHINE_JITTER = config.get("machine.jitter", 0.1)
+    MACHINE_WORKERS = config.get("machine.workers", 64)
 
     # Solace REST API URL
-    SOLACE_REST_URL = f"{http_protocol}{userpass}{SOLACE_HOST}:{SOLACE_REST_PORT}"
+    SOLACE_REST_URL = get_solace_rest_url()
 
-    # Start the loop sending messages in a separate thread
-    loop_thread = threading.Thread(target=run_loop, daemon=True)
-    loop_thread.start()
+    if MACHINE_FLEET:
+        # Start the fleet simulation in separate threads
+        fleet = Fleet(MACHINE_PLANTS, MACHINE_BUILDINGS, MACHINE_MACHINES, MACHINE_INTERVAL, MACHINE_JITTER, MACHINE_WORKERS, MACHINE_REST)
+        threading.Thread(target=fleet.run, daemon=True).start()
+        threading.Thread(target=fleet.report, daemon=True).start()
+        tprint(f"Fleet of {len(fleet.machines)} machines started, one message per machine every {MACHINE_INTERVAL}s")
+    else:
+        # Start the loop sending messages in a separate thread
+        loop_thread = threading.Thread(target=run_loop, daemon=True)
+        loop_thread.start()
 
     # Start the HTTP server in the main thread
     run_http_server()
\ No newline at end of file
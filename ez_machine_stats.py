@@ -0,0 +1,104 @@
+# general
+import time
+
+FEATURES = ('dli', 'sri', 'odi')
+
+class MachineStats:
+    """Running per-machine count, sums and sums of squares of the dli, sri and odi levels.
+
+    Kept in memory and in the machine_stats table, updated with every inserted batch in the same
+    transaction, so a peer mean is a lookup instead of a GROUP BY over all history. With a half_life
+    in seconds older readings weigh exponentially less, 0 keeps plain totals. Several subscriber
+    processes can update the table, each batch starts from the stored rows, load() refreshes the
+    in-memory copy with what the others wrote."""
+    def __init__(self, conn, half_life=0):
+        self.half_life = half_life
+        self.stats = {}
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS machine_stats (
+                    machine_id TEXT PRIMARY KEY,
+                    count REAL,
+                    sum_dli REAL,
+                    sum_sri REAL,
+                    sum_odi REAL,
+                    sumsq_dli REAL,
+                    sumsq_sri REAL,
+                    sumsq_odi REAL,
+                    updated REAL
+                )
+            ''')
+            if conn.execute("SELECT COUNT(*) FROM machine_stats").fetchone()[0] == 0:
+                # First run on an existing database, build the totals from the stored transactions once
+                # OR IGNORE, another subscriber starting at the same time may have filled it already
+                conn.execute('''
+                    INSERT OR IGNORE INTO machine_stats
+                    SELECT machine_id, COUNT(*), SUM(dli), SUM(sri), SUM(odi), SUM(dli * dli), SUM(sri * sri), SUM(odi * odi), ?
+                    FROM transactions WHERE dli IS NOT NULL AND sri IS NOT NULL AND odi IS NOT NULL GROUP BY machine_id
+                ''', (time.time(),))
+        self.load(conn)
+
+    def load(self, conn):
+        """Reads all machines from the table, including the updates of other subscribers."""
+        self.stats = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT * FROM machine_stats")}
+
+    def updated_rows(self, transactions, now=None, current=None):
+        """New stats rows for the machines in a batch of transactions, not applied yet.
+
+        current are the stats rows to start from, by default the in-memory ones."""
+        now = time.time() if now is None else now
+        current = self.stats if current is None else current
+        rows = {}
+        for transaction in transactions:
+            try:
+                dli, sri, odi = (float(transaction[feature]) for feature in FEATURES)
+            except (TypeError, ValueError):
+                # "Unknown" when the gateway found no level, left out as in the rollups
+                continue
+            machine_id = transaction['machine_id']
+            count, sum_dli, sum_sri, sum_odi, sumsq_dli, sumsq_sri, sumsq_odi, updated = rows.get(machine_id) or current.get(machine_id) or (0, 0, 0, 0, 0, 0, 0, now)
+            decay = 0.5 ** ((now - updated) / self.half_life) if self.half_life else 1
+            rows[machine_id] = (
+                count * decay + 1,
+                sum_dli * decay + dli, sum_sri * decay + sri, sum_odi * decay + odi,
+                sumsq_dli * decay + dli * dli, sumsq_sri * decay + sri * sri, sumsq_odi * decay + odi * odi,
+                now
+            )
+        return rows
+
+    def write(self, conn, transactions):
+        """Upserts the stats of a batch inside the caller's write transaction, apply() the result after the commit."""
+        # The stored rows, not the in-memory ones: the caller holds the write lock, so no other subscriber can change them meanwhile
+        machine_ids = list({transaction['machine_id'] for transaction in transactions})
+        current = {
+            row[0]: tuple(row[1:])
+            for row in conn.execute(f"SELECT * FROM machine_stats WHERE machine_id IN ({','.join('?' * len(machine_ids))})", machine_ids)
+        }
+        rows = self.updated_rows(transactions, current=current)
+        conn.executemany(
+            "INSERT OR REPLACE INTO machine_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(machine_id,) + row for machine_id, row in rows.items()]
+        )
+        return rows
+
+    def apply(self, rows):
+        self.stats.update(rows)
+
+    def mean(self, machine_id):
+        """(dli, sri, odi) means of a machine, None for a machine without readings."""
+        row = self.stats.get(machine_id)
+        if not row or not row[0]:
+            return None
+        return tuple(total / row[0] for total in row[1:4])
+
+    def std(self, machine_id):
+        """(dli, sri, odi) standard deviations of a machine, None for a machine without readings."""
+        row = self.stats.get(machine_id)
+        if not row or not row[0]:
+            return None
+        return tuple(max(0.0, sumsq / row[0] - (total / row[0]) ** 2) ** 0.5 for total, sumsq in zip(row[1:4], row[4:7]))
+
+    def peer_sum(self, machine_id):
+        """Sum of the dli, sri and odi means of a machine, the peer-group baseline of analyze_risk."""
+        mean = self.mean(machine_id)
+        return sum(mean) if mean else None
@@ -0,0 +1,150 @@
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from half a millisecond up to the 10 second publish timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    """Formats a label dict as {name="value",...}, empty string without labels."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+class Counter:
+    """Monotonically increasing value, or read from a callback at scrape time."""
+    kind = "counter"
+
+    def __init__(self, labels, callback=None):
+        self.labels = labels
+        self.callback = callback
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        value = self.callback() if self.callback else self.value
+        yield f"{name}{format_labels(self.labels)} {value}"
+
+class Gauge:
+    """Value that goes up and down, or is read from a callback at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, labels, callback=None):
+        self.labels = labels
+        self.callback = callback
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        value = self.callback() if self.callback else self.value
+        yield f"{name}{format_labels(self.labels)} {value}"
+
+class Histogram:
+    """Counts observations into fixed buckets, cheap enough to record every request."""
+    kind = "histogram"
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket{format_labels({**self.labels, 'le': le})} {cumulative}"
+        yield f"{name}_sum{format_labels(self.labels)} {total}"
+        yield f"{name}_count{format_labels(self.labels)} {cumulative}"
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text exposition format."""
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, {"kind": kind, "help": help_text, "metrics": {}})
+            if key not in family["metrics"]:
+                family["metrics"][key] = factory()
+            return family["metrics"][key]
+
+    def counter(self, name, help_text, callback=None, **labels):
+        return self._get("counter", name, help_text, labels, lambda: Counter(labels, callback))
+
+    def gauge(self, name, help_text, callback=None, **labels):
+        return self._get("gauge", name, help_text, labels, lambda: Gauge(labels, callback))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(labels, buckets))
+
+    def render(self):
+        """Returns all metrics as Prometheus text, every sample labelled with the process id."""
+        pid = f'pid="{os.getpid()}"'
+        lines = []
+        with self.lock:
+            families = [(name, dict(family, metrics=list(family["metrics"].values()))) for name, family in self.families.items()]
+        for name, family in families:
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['kind']}")
+            for metric in family["metrics"]:
+                for sample in metric.samples(name):
+                    # Worker processes each keep their own metrics, the pid label keeps their series apart
+                    if "{" in sample:
+                        sample = sample.replace("{", "{" + pid + ",", 1)
+                    else:
+                        metric_name, value = sample.split(" ", 1)
+                        sample = f"{metric_name}{{{pid}}} {value}"
+                    lines.append(sample)
+        return "\n".join(lines) + "\n"
+
+def serve_metrics(registry, host="localhost", port=0):
+    """Serves registry on GET /metrics from a background thread, for processes without an HTTP server of their own."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
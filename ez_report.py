@@ -0,0 +1,94 @@
+# general
+import datetime
+import glob
+import json
+import os
+import time
+
+def to_json(value):
+    """json.dumps default for numpy and pandas values in report records."""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+class ReportWriter:
+    """Appends flagged transactions to a JSON Lines report, one object per line.
+
+    Only records with an id above the high-water mark are written, the mark is kept next to the
+    report in <report>.hwm so a restart does not report the same transactions again. The report is
+    rotated to <name>-<time><ext> when it reaches max_bytes or is max_age seconds old, counted from
+    the time kept in <report>.opened when the report was started. The newest keep rotated files are kept."""
+    def __init__(self, path, max_bytes=10485760, max_age=86400, keep=7):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.hwm_path = path + ".hwm"
+        self.opened_path = path + ".opened"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = None
+        self.open()
+
+    def open(self):
+        try:
+            with open(self.hwm_path) as f:
+                self.hwm = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self.hwm = 0
+        self.file = open(self.path, "a", encoding="utf-8")
+        if not self.file.tell():
+            self.opened = time.time()
+            self.replace_text(self.opened_path, repr(self.opened))
+            return
+        # A continued report is as old as when it was started, the file's creation time is not portable
+        try:
+            with open(self.opened_path) as f:
+                self.opened = float(f.read())
+        except (OSError, ValueError):
+            # Started before the time was kept, its last write is the best known bound
+            self.opened = os.path.getmtime(self.path)
+
+    def write(self, records):
+        """Writes the records with an id above the high-water mark, returns how many were written."""
+        new = [record for record in records if record['id'] > self.hwm]
+        if not new:
+            return 0
+        self.file.write("".join(json.dumps(record, default=to_json) + "\n" for record in new))
+        self.file.flush()
+        self.save_hwm(max(record['id'] for record in new))
+        if self.file.tell() >= self.max_bytes or (self.max_age and time.time() - self.opened >= self.max_age):
+            self.rotate()
+        return len(new)
+
+    def save_hwm(self, hwm):
+        # Written after the records: a crash in between repeats a few lines, it never skips any
+        self.hwm = hwm
+        self.replace_text(self.hwm_path, str(hwm))
+
+    def replace_text(self, path, text):
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(text)
+        os.replace(temporary, path)
+
+    def rotate(self):
+        self.file.close()
+        base, ext = os.path.splitext(self.path)
+        # Microseconds, a second rotation within the same second must not replace the first
+        os.replace(self.path, f"{base}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{ext}")
+        rotated = sorted(glob.glob(f"{glob.escape(base)}-*{ext}"))
+        for old in rotated[:-self.keep] if self.keep else []:
+            os.remove(old)
+        self.open()
+
+    def reopen(self):
+        """Continues the report and high-water mark as another process left them, e.g. after taking over the analysis."""
+        self.close()
+        self.open()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,142 @@
+# general
+import time
+
+# Rollup table -> bucket size in seconds, buckets start at multiples of it in UTC
+GRANULARITIES = {'minute': 60, 'hour': 3600, 'day': 86400}
+# Cleaning class -> rollup count column
+CLEANING_COLUMNS = {
+    'not required': 'cleaning_not_required',
+    'recommended': 'cleaning_recommended',
+    'urgently needed': 'cleaning_urgently_needed',
+}
+LEVELS = ('dli', 'sri', 'odi')
+# Rollup columns after bucket, machine, plant and building
+VALUE_COLUMNS = ['count'] + [f"{stat}_{level}" for level in LEVELS for stat in ('sum', 'min', 'max')] + list(CLEANING_COLUMNS.values())
+
+def create_rollups(conn):
+    for name in GRANULARITIES:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS rollup_{name} (
+                bucket INTEGER,
+                machine INTEGER REFERENCES machine(id),
+                plant INTEGER REFERENCES plant(id),
+                building INTEGER REFERENCES building(id),
+                {", ".join(f"{column} {'REAL' if column.startswith('sum_') else 'INTEGER'}" for column in VALUE_COLUMNS)},
+                PRIMARY KEY (bucket, machine)
+            )
+        ''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS rollup_{name}_bucket ON rollup_{name} (bucket)")
+
+def backfill_rollups(conn):
+    """Rebuilds the rollups from the readings, for a database from before the rollup tables."""
+    cleaning_counts = ", ".join(f"SUM(cleaning.name = '{cleaning}')" for cleaning in CLEANING_COLUMNS)
+    level_stats = ", ".join(f"SUM({level}), MIN({level}), MAX({level})" for level in LEVELS)
+    for name, seconds in GRANULARITIES.items():
+        conn.execute(f"DELETE FROM rollup_{name}")
+        conn.execute(f'''
+            INSERT INTO rollup_{name}
+            SELECT r.timestamp / 1000000 / {seconds} * {seconds}, r.machine, MIN(r.plant), MIN(r.building), COUNT(*), {level_stats}, {cleaning_counts}
+            FROM readings r LEFT JOIN level AS cleaning ON cleaning.id = r.cleaning
+            WHERE r.timestamp IS NOT NULL AND r.dli IS NOT NULL AND r.sri IS NOT NULL AND r.odi IS NOT NULL
+            GROUP BY 1, r.machine
+        ''')
+
+def update_rollups(conn, readings, cleanings):
+    """Adds a batch of readings rows to every rollup, inside the caller's transaction.
+
+    readings are rows as encoded by Dimensions.encode, cleanings the cleaning class of each."""
+    for name, seconds in GRANULARITIES.items():
+        buckets = {}
+        for row, cleaning in zip(readings, cleanings):
+            plant, building, machine = row[0:3]
+            timestamp_us, dli, sri, odi = row[11:15]
+            if timestamp_us is None or dli is None or sri is None or odi is None:
+                continue
+            key = (timestamp_us // 1000000 // seconds * seconds, machine)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [plant, building, 0] + [0, None, None] * len(LEVELS) + [0] * len(CLEANING_COLUMNS)
+            bucket[2] += 1
+            for i, value in enumerate((dli, sri, odi)):
+                offset = 3 + 3 * i
+                bucket[offset] += value
+                bucket[offset + 1] = value if bucket[offset + 1] is None else min(bucket[offset + 1], value)
+                bucket[offset + 2] = value if bucket[offset + 2] is None else max(bucket[offset + 2], value)
+            if cleaning in CLEANING_COLUMNS:
+                bucket[3 + 3 * len(LEVELS) + list(CLEANING_COLUMNS).index(cleaning)] += 1
+        if not buckets:
+            continue
+        updates = ", ".join(
+            f"{column} = MIN({column}, excluded.{column})" if column.startswith('min_') else
+            f"{column} = MAX({column}, excluded.{column})" if column.startswith('max_') else
+            f"{column} = {column} + excluded.{column}"
+            for column in VALUE_COLUMNS
+        )
+        conn.executemany(f'''
+            INSERT INTO rollup_{name} (bucket, machine, plant, building, {", ".join(VALUE_COLUMNS)})
+            VALUES ({", ".join("?" * (4 + len(VALUE_COLUMNS)))})
+            ON CONFLICT (bucket, machine) DO UPDATE SET {updates}
+        ''', [key + tuple(bucket) for key, bucket in buckets.items()])
+
+ARCHIVE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS archive.transactions (
+        id INTEGER PRIMARY KEY,
+        plant_id TEXT, building_id TEXT, machine_id TEXT, payload TEXT, cpaid TEXT, conversationid TEXT,
+        service TEXT, action TEXT, timestamp TEXT, dust TEXT, sticky TEXT, odor TEXT, cleaning TEXT,
+        dli INTEGER, sri INTEGER, odi INTEGER, timestamp_us INTEGER, messageid TEXT
+    )
+'''
+ARCHIVE_COLUMNS = (
+    "id, plant_id, building_id, machine_id, payload, cpaid, conversationid, service, action, timestamp, dust, sticky, odor, cleaning,"
+    " dli, sri, odi, timestamp_us, messageid"
+)
+
+def remove_readings(conn, where, params, archive_db, chunk_size):
+    """Deletes the readings matching where, after copying them to the attached archive with archive_db, in chunks."""
+    removed = 0
+    while True:
+        with conn:
+            ids = [row[0] for row in conn.execute(f"SELECT id FROM readings WHERE {where} LIMIT ?", params + (chunk_size,))]
+            if not ids:
+                return removed
+            placeholders = ",".join("?" * len(ids))
+            if archive_db:
+                # OR IGNORE, the archive and main database commit separately and a chunk can be copied twice after a crash
+                conn.execute(f"INSERT OR IGNORE INTO archive.transactions ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM transactions WHERE id IN ({placeholders})", ids)
+            conn.execute(f"DELETE FROM readings WHERE id IN ({placeholders})", ids)
+        removed += len(ids)
+
+def apply_retention(conn, retention_days, archive_db="", chunk_size=10000, log=print):
+    """Deletes raw readings and rollup buckets older than their retention in days, 0 keeps them forever.
+
+    retention_days maps 'raw', 'minute', 'hour' and 'day' to days. Raw readings without a timestamp are
+    aged by when they were stored, they go once every reading stored before them has gone. With archive_db the raw readings are
+    first copied to the transactions table of that sqlite file. Works in chunks of short transactions so
+    the subscriber is not held up."""
+    now = time.time()
+    raw_days = retention_days.get('raw', 0)
+    if raw_days:
+        horizon = int((now - raw_days * 86400) * 1000000)
+        if archive_db:
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_db,))
+            conn.execute(ARCHIVE_TABLE)
+            if 'messageid' not in [row[1] for row in conn.execute("PRAGMA archive.table_info(transactions)")]:
+                # Archive created before schema version 4
+                conn.execute("ALTER TABLE archive.transactions ADD COLUMN messageid TEXT")
+        try:
+            removed = remove_readings(conn, "timestamp < ? ORDER BY timestamp", (horizon,), archive_db, chunk_size)
+            # Readings with an unparsable timestamp are aged by insertion order: those stored before the
+            # first reading still kept. +timestamp walks the ids, which start at the oldest kept rows.
+            kept = conn.execute("SELECT id FROM readings WHERE +timestamp >= ? ORDER BY id LIMIT 1", (horizon,)).fetchone()
+            if kept:
+                removed += remove_readings(conn, "timestamp IS NULL AND id < ? ORDER BY id", (kept[0],), archive_db, chunk_size)
+        finally:
+            if archive_db:
+                conn.execute("DETACH DATABASE archive")
+        if removed:
+            log(f"Retention: {'archived' if archive_db else 'deleted'} {removed} readings older than {raw_days} days")
+    for name, seconds in GRANULARITIES.items():
+        days = retention_days.get(name, 0)
+        if days:
+            with conn:
+                conn.execute(f"DELETE FROM rollup_{name} WHERE bucket < ?", (int(now - days * 86400),))
@@ -0,0 +1,247 @@
+# general
+import datetime
+import sqlite3
+# ez
+from ez_rollups import create_rollups, backfill_rollups
+from ez_dedup import message_id
+
+# Schema versions, kept in PRAGMA user_version
+# 1: the original transactions table, every column TEXT and no indexes (databases from before versioning report 0)
+# 2: readings fact table with dimension ids, epoch timestamps and indexes, transactions is a view on it
+# 3: minute, hour and day rollup tables per machine
+# 4: readings.messageid with a unique index, redelivered messages are stored once
+SCHEMA_VERSION = 4
+
+# Dimension tables, each maps distinct names to small integer ids
+DIMENSIONS = ('plant', 'building', 'machine', 'conversation', 'cpa', 'service', 'action', 'level')
+# Transaction field -> dimension table, the dust, sticky, odor and cleaning classes share one table
+FIELDS = {
+    'plant_id': 'plant',
+    'building_id': 'building',
+    'machine_id': 'machine',
+    'conversationid': 'conversation',
+    'cpaid': 'cpa',
+    'service': 'service',
+    'action': 'action',
+    'dust': 'level',
+    'sticky': 'level',
+    'odor': 'level',
+    'cleaning': 'level',
+}
+
+# Fields of the JSON message the gateway publishes, all needed to store a reading
+MESSAGE_FIELDS = tuple(FIELDS) + ('timestamp', 'dli', 'sri', 'odi', 'payload')
+
+INSERT_READING = '''
+    INSERT INTO readings (
+        plant, building, machine, conversation, cpa, service, action, dust, sticky, odor, cleaning,
+        timestamp, dli, sri, odi, payload, messageid
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Local time ISO 8601 text of the microsecond epoch timestamp, as the machines send it
+ISO_TIMESTAMP = (
+    "strftime('%Y-%m-%dT%H:%M:%S', r.timestamp / 1000000, 'unixepoch', 'localtime')"
+    " || CASE WHEN r.timestamp % 1000000 THEN printf('.%06d', r.timestamp % 1000000) ELSE '' END"
+)
+
+# The original transactions columns, so the dashboard, analysis and Solace Agent Mesh queries keep working,
+# plus timestamp_us to select a time window with the readings timestamp index and the messageid
+TRANSACTIONS_VIEW = f'''
+    CREATE VIEW IF NOT EXISTS transactions AS
+    SELECT
+        r.id AS id,
+        plant.name AS plant_id,
+        building.name AS building_id,
+        machine.name AS machine_id,
+        COALESCE(r.payload, '[' || {ISO_TIMESTAMP} || '] Dust level: ' || dust.name || ', Sticky residue: ' || sticky.name
+            || ', Odor: ' || odor.name || '. Cleaning: ' || cleaning.name || '.') AS payload,
+        cpa.name AS cpaid,
+        conversation.name AS conversationid,
+        service.name AS service,
+        action.name AS action,
+        {ISO_TIMESTAMP} AS timestamp,
+        dust.name AS dust,
+        sticky.name AS sticky,
+        odor.name AS odor,
+        cleaning.name AS cleaning,
+        r.dli AS dli,
+        r.sri AS sri,
+        r.odi AS odi,
+        r.timestamp AS timestamp_us,
+        r.messageid AS messageid
+    FROM readings r
+    LEFT JOIN plant ON plant.id = r.plant
+    LEFT JOIN building ON building.id = r.building
+    LEFT JOIN machine ON machine.id = r.machine
+    LEFT JOIN conversation ON conversation.id = r.conversation
+    LEFT JOIN cpa ON cpa.id = r.cpa
+    LEFT JOIN service ON service.id = r.service
+    LEFT JOIN action ON action.id = r.action
+    LEFT JOIN level AS dust ON dust.id = r.dust
+    LEFT JOIN level AS sticky ON sticky.id = r.sticky
+    LEFT JOIN level AS odor ON odor.id = r.odor
+    LEFT JOIN level AS cleaning ON cleaning.id = r.cleaning
+'''
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def to_timestamp_us(iso):
+    """Microseconds since the epoch of an ISO 8601 timestamp, local time when it has no offset. None if unparsable."""
+    try:
+        dt = datetime.datetime.fromisoformat(iso)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.astimezone()
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+def from_timestamp_us(timestamp_us):
+    """Local time ISO 8601 text of a microsecond epoch timestamp, the inverse of to_timestamp_us."""
+    dt = EPOCH + datetime.timedelta(microseconds=timestamp_us)
+    return dt.astimezone().replace(tzinfo=None).isoformat()
+
+def to_int(value):
+    """Level index as an integer, None for a missing or malformed one."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def malformed(transaction):
+    """Why a parsed message cannot be stored, None when it can. A missing field or a nested value fails the same way on every write."""
+    if not isinstance(transaction, dict):
+        return "not a JSON object"
+    missing = [field for field in MESSAGE_FIELDS if field not in transaction]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    nested = [field for field in MESSAGE_FIELDS if isinstance(transaction[field], (dict, list))]
+    if nested:
+        return f"not a text or number: {', '.join(nested)}"
+    return None
+
+def standard_payload(transaction):
+    """The payload text the machines send, rebuilt from the other fields."""
+    return (
+        f"[{transaction['timestamp']}] Dust level: {transaction['dust']}, Sticky residue: {transaction['sticky']}, "
+        f"Odor: {transaction['odor']}. Cleaning: {transaction['cleaning']}."
+    )
+
+class Dimensions:
+    """In-memory name -> id dictionaries of the dimension tables, new names are added as they arrive."""
+    def __init__(self, conn):
+        self.ids = {dimension: dict(conn.execute(f"SELECT name, id FROM {dimension}")) for dimension in DIMENSIONS}
+
+    def id(self, conn, dimension, name, pending):
+        if name is None:
+            return None
+        found = self.ids[dimension].get(name) or pending.get((dimension, name))
+        if found is None:
+            # OR IGNORE, another subscriber on the same database may have added it since
+            conn.execute(f"INSERT OR IGNORE INTO {dimension} (name) VALUES (?)", (name,))
+            found = conn.execute(f"SELECT id FROM {dimension} WHERE name = ?", (name,)).fetchone()[0]
+            pending[(dimension, name)] = found
+        return found
+
+    def encode(self, conn, transactions):
+        """readings rows for parsed transactions and the new dimension ids, apply() those after the commit."""
+        pending = {}
+        rows = []
+        for transaction in transactions:
+            timestamp_us = to_timestamp_us(transaction['timestamp'])
+            payload = transaction['payload']
+            # Only payloads that cannot be rebuilt from the other columns are stored
+            if timestamp_us is not None and payload == standard_payload(transaction) and from_timestamp_us(timestamp_us) == transaction['timestamp']:
+                payload = None
+            rows.append(tuple(self.id(conn, dimension, transaction[field], pending) for field, dimension in FIELDS.items()) + (
+                timestamp_us, to_int(transaction['dli']), to_int(transaction['sri']), to_int(transaction['odi']), payload,
+                message_id(transaction)
+            ))
+        return rows, pending
+
+    def apply(self, pending):
+        for (dimension, name), id in pending.items():
+            self.ids[dimension][name] = id
+
+def create_schema(conn):
+    for dimension in DIMENSIONS:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {dimension} (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS readings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plant INTEGER REFERENCES plant(id),
+            building INTEGER REFERENCES building(id),
+            machine INTEGER REFERENCES machine(id),
+            conversation INTEGER REFERENCES conversation(id),
+            cpa INTEGER REFERENCES cpa(id),
+            service INTEGER REFERENCES service(id),
+            action INTEGER REFERENCES action(id),
+            dust INTEGER REFERENCES level(id),
+            sticky INTEGER REFERENCES level(id),
+            odor INTEGER REFERENCES level(id),
+            cleaning INTEGER REFERENCES level(id),
+            timestamp INTEGER,
+            dli INTEGER,
+            sri INTEGER,
+            odi INTEGER,
+            payload TEXT,
+            messageid TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS readings_machine_timestamp ON readings (machine, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS readings_timestamp ON readings (timestamp)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS readings_messageid ON readings (messageid) WHERE messageid IS NOT NULL")
+    conn.execute(TRANSACTIONS_VIEW)
+    create_rollups(conn)
+
+def migrate(conn, chunk_size=10000, log=print):
+    """Brings the database to SCHEMA_VERSION in one transaction, converting a version 1 transactions table.
+
+    A converted database is vacuumed afterwards, the pages of the dropped table would otherwise stay in the file."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with conn:
+        # DDL does not start a transaction by itself, without BEGIN a failed migration would be left halfway
+        conn.execute("BEGIN IMMEDIATE")
+        # Another subscriber starting at the same time may have migrated while this one waited for the lock
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        legacy = conn.execute("SELECT type FROM sqlite_master WHERE name = 'transactions'").fetchone()
+        if legacy and legacy[0] == 'table':
+            conn.execute("ALTER TABLE transactions RENAME TO transactions_v1")
+        elif version in (2, 3):
+            # Rows stored before have no messageid, the view is recreated with the new column
+            conn.execute("ALTER TABLE readings ADD COLUMN messageid TEXT")
+            conn.execute("DROP VIEW transactions")
+        create_schema(conn)
+        if legacy and legacy[0] == 'table':
+            dimensions = Dimensions(conn)
+            columns = ['id'] + list(FIELDS) + ['timestamp', 'dli', 'sri', 'odi', 'payload']
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM transactions_v1 ORDER BY id")
+            copied = 0
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                transactions = [dict(zip(columns, row)) for row in chunk]
+                rows, pending = dimensions.encode(conn, transactions)
+                dimensions.apply(pending)
+                # Keep the ids, reports and exports refer to them
+                conn.executemany(
+                    INSERT_READING.replace("INSERT INTO readings (", "INSERT INTO readings (id, ").replace("VALUES (", "VALUES (?, "),
+                    [(transaction['id'],) + row for transaction, row in zip(transactions, rows)]
+                )
+                copied += len(chunk)
+            conn.execute("DROP TABLE transactions_v1")
+            log(f"Migrated {copied} transactions to schema version {SCHEMA_VERSION}")
+        if version < 3:
+            backfill_rollups(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if legacy and legacy[0] == 'table':
+        # VACUUM cannot run inside a transaction, so only after the commit
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            log(f"Could not vacuum the converted database, run VACUUM to release the space of the old table: {e}")
@@ -0,0 +1,205 @@
+# general
+import argparse
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+# ez
+from ez_config_loader import ConfigLoader
+
+# Traffic files are append-only: a data file of records and an index file of record offsets.
+# Data file: MAGIC, then per record RECORD header, key (plant/building/machine) and body.
+# Index file: one little-endian uint64 data file offset per record, for counting and random access without a scan.
+MAGIC = b"EZTRAF01"
+RECORD = struct.Struct("<dIHH")  # capture time in seconds, body length, key length, flags
+OFFSET = struct.Struct("<Q")
+FLAG_ZLIB = 1
+# The ebXML MessageId element of a recorded message, with any namespace prefix
+MESSAGE_ID = re.compile(rb"(<(?:[\w.-]+:)?MessageId>)[^<]*(</)")
+
+def tprint(string=""):
+    """Takes a string and prints it with a timestamp prefixt."""
+    print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
+
+class TrafficWriter:
+    """Appends SOAP messages with their capture time to a traffic file, safe to share between threads."""
+    def __init__(self, path, compress=True):
+        self.path = path
+        self.compress = compress
+        self.lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.data = open(path, "ab")
+        self.index = open(path + ".idx", "ab")
+        if new:
+            self.data.write(MAGIC)
+
+    def append(self, soap_message, key="", timestamp=None):
+        body = soap_message.encode('utf-8') if isinstance(soap_message, str) else soap_message
+        flags = 0
+        if self.compress:
+            body = zlib.compress(body, 6)
+            flags |= FLAG_ZLIB
+        key = key.encode('utf-8')
+        record = RECORD.pack(time.time() if timestamp is None else timestamp, len(body), len(key), flags) + key + body
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(record)
+            # Data before index, a crash can leave an unindexed record but never an index entry without data
+            self.data.flush()
+            self.index.write(OFFSET.pack(offset))
+            self.index.flush()
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+class TrafficReader:
+    """Memory-maps a traffic file and its index for random access to the recorded messages."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as data:
+            self.data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' is not a traffic file")
+        with open(path + ".idx", "rb") as index:
+            size = os.fstat(index.fileno()).st_size
+            self.index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = len(self.index) // OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, i):
+        offset, = OFFSET.unpack_from(self.index, i * OFFSET.size)
+        return RECORD.unpack_from(self.data, offset)[0]
+
+    def record(self, i):
+        """Returns (timestamp, key, soap_message bytes) of record i."""
+        offset, = OFFSET.unpack_from(self.index, i * OFFSET.size)
+        timestamp, body_length, key_length, flags = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        key = self.data[start:start + key_length].decode('utf-8')
+        body = self.data[start + key_length:start + key_length + body_length]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        return timestamp, key, body
+
+def record_generated(path, count, rate, seed=None):
+    """Records count generated readings, rate per second apart, for random machines from config.json."""
+    # Imported here, replaying does not need the sender module and its requests dependency
+    from ez_machine import SoapTemplate
+    from ez_benchmark import machine_list
+    random.seed(seed)
+    template = SoapTemplate()
+    machines = machine_list(MACHINE_RANGES)
+    writer = TrafficWriter(path)
+    start = time.time()
+    for first in range(0, count, 1000):
+        # Every reading carries its own capture time, as a machine would send it
+        times = [start + i / rate for i in range(first, min(first + 1000, count))]
+        for timestamp, (plant_id, building_id, machine_id, soap_message) in zip(times, template.generate(machines, len(times), times)):
+            writer.append(soap_message, f"{plant_id}/{building_id}/{machine_id}", timestamp)
+    writer.close()
+    tprint(f"Recorded {count} messages to {path}")
+
+def fresh_message_id(body):
+    """The SOAP message with a new MessageId, so the subscribers store it instead of dropping it as a duplicate."""
+    return MESSAGE_ID.sub(lambda match: match.group(1) + str(uuid.uuid4()).encode('ascii') + match.group(2), body, count=1)
+
+def replay(path, target, url, speed, senders, compress=False, fresh_ids=False):
+    """Replays a traffic file at speed times the recorded pace, 0 sends as fast as possible.
+
+    The recorded MessageIds are sent as they are, the subscribers store a message once, so a second
+    replay against the same stores writes nothing. fresh_ids gives every message a new MessageId."""
+    from ez_machine import send_message
+    from ez_benchmark import report
+    import requests
+    reader = TrafficReader(path)
+    if not len(reader):
+        tprint(f"No messages in {path}")
+        return
+    first = reader.timestamp(0)
+    lock = threading.Lock()
+    state = {"next": 0, "errors": 0}
+    latencies = []
+
+    def sender():
+        session = requests.Session()
+        local_latencies = []
+        errors = 0
+        while True:
+            with lock:
+                i = state["next"]
+                state["next"] += 1
+            if i >= len(reader):
+                break
+            timestamp, key, body = reader.record(i)
+            if fresh_ids:
+                body = fresh_message_id(body)
+            # Latency counts from the replay schedule, not from when a sender got around to it
+            intended = start + (timestamp - first) / speed if speed else time.perf_counter()
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            target_url = url if target == "gateway" else f"{url}/{key}"
+            machine_id = key.rsplit("/", 1)[-1]
+            if send_message(target_url, body.decode('utf-8'), machine_id, compress, session) is None:
+                errors += 1
+            else:
+                local_latencies.append(time.perf_counter() - intended)
+        with lock:
+            latencies.extend(local_latencies)
+            state["errors"] += errors
+
+    tprint(f"Replaying {len(reader)} messages from {path} to {target} at {'max' if not speed else f'{speed}x'} speed")
+    start = time.perf_counter()
+    threads = [threading.Thread(target=sender, daemon=True) for _ in range(senders)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report(target, latencies, state["errors"], time.perf_counter() - start)
+
+if __name__ == "__main__":
+    # Load values from the configuration
+    config = ConfigLoader("config.json")
+    APP_URL = config.get("app.url")
+    APP_TOPIC = config.get("app.topic")
+    MACHINE_RANGES = (config.get("machine.plants", 3), config.get("machine.buildings", 2), config.get("machine.machines", 4))
+
+    parser = argparse.ArgumentParser(description="Record and replay Cleanpulse SOAP traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="record generated readings")
+    record_parser.add_argument("file", help="traffic file, e.g. transactions/sample.ezt")
+    record_parser.add_argument("-n", "--count", type=int, default=10000)
+    record_parser.add_argument("-r", "--rate", type=float, default=100, help="recorded messages per second")
+    record_parser.add_argument("--seed", type=int, default=None)
+    replay_parser = subparsers.add_parser("replay", help="replay a traffic file")
+    replay_parser.add_argument("file")
+    replay_parser.add_argument("--target", choices=("gateway", "rest"), default="gateway")
+    replay_parser.add_argument("--speed", type=float, default=1, help="1 for recorded pace, N for N times faster, 0 for max")
+    replay_parser.add_argument("-s", "--senders", type=int, default=64)
+    replay_parser.add_argument("--gzip", action="store_true", help="gzip request bodies to the gateway")
+    replay_parser.add_argument("--fresh-ids", action="store_true", help="send every message with a new MessageId, so a replay against the same stores is stored again")
+    info_parser = subparsers.add_parser("info", help="show the number of messages and time span")
+    info_parser.add_argument("file")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_generated(args.file, args.count, args.rate, args.seed)
+    elif args.command == "replay":
+        if args.target == "gateway":
+            replay(args.file, "gateway", APP_URL, args.speed, args.senders, args.gzip, args.fresh_ids)
+        else:
+            from ez_machine import get_solace_rest_url
+            replay(args.file, "rest", f"{get_solace_rest_url()}/{APP_TOPIC}/xml/v1", args.speed, args.senders, fresh_ids=args.fresh_ids)
+    elif args.command == "info":
+        reader = TrafficReader(args.file)
+        span = reader.timestamp(len(reader) - 1) - reader.timestamp(0) if len(reader) else 0
+        tprint(f"{args.file}: {len(reader)} messages over {span:.1f}s, {os.path.getsize(args.file)} bytes")
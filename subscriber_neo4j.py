@@ -1,7 +1,7 @@
 # general
+import datetime
 import json
 import os
-import uuid
 import time
 # solace
 from solace.messaging.messaging_service import MessagingService, RetryStrategy
@@ -11,34 +11,42 @@ from solace.messaging.receiver.inbound_message import InboundMessage
 from solace.messaging.config.transport_security_strategy import TLS
 # neo4j
 from neo4j import GraphDatabase
+from neo4j.exceptions import ConstraintError, CypherTypeError
 # ez
 from ez_config_loader import ConfigLoader
+from ez_batch_writer import BatchWriter
+from ez_dispatcher import KeyedDispatcher, machine_key
+from ez_metrics import MetricsRegistry, serve_metrics
+from ez_dedup import RecentIdCache, message_id
+from ez_rollups import CLEANING_COLUMNS, LEVELS
+from ez_sqlite_schema import FIELDS, malformed, to_int
 
-def insert_transaction(transaction_json, neo4j_driver):
-    """Insert transaction into Neo4j."""
-    transaction = json.loads(transaction_json)
+def insert_transactions(transactions):
+    """BatchWriter flush: write a batch of parsed transactions in one transaction of the long-lived session."""
+    stored, merged = session.execute_write(create_graph, transactions)
+    # Only once committed, a failed batch is retried and its messages must not be skipped as duplicates then
+    recent_ids.update(message_id(transaction) for transaction in transactions)
+    ensured.update(edge for transaction in merged for edge in dimension_edges(transaction))
+    duplicates.inc(len(transactions) - len(stored))
+    if APP_DEBUG:
+        tprint(f"Inserted {len(stored)} transactions into Neo4j, {len(stored) - len(merged)} with known dimensions.")
+    prune_payloads()
 
-    # Insert into Neo4j
-    with neo4j_driver.session() as session:
-        #tprint(transaction)
-        session.execute_write(create_graph, transaction)
-        tprint("Inserted transaction into Neo4j.")
-        pass
-
-def create_graph(tx, transaction):
-    """Create nodes and relationships in Neo4j."""
-    query = """
-    MERGE (pi:PlantID {dt: $plant_id})
-    MERGE (bi:BuildingID {dt: $building_id})
-    MERGE (mi:MachineID {dt: $machine_id})
-    MERGE (cp:CpaID {dt: $cpaid})
-    MERGE (cid:ConversationID {dt: $conversationid})
-    MERGE (s:Service {dt: $service})
-    MERGE (a:Action {dt: $action})
-    MERGE (dl:DustLevel {dt: $dust})
-    MERGE (sr:StickyResidu {dt: $sticky})
-    MERGE (od:Odor {dt: $odor})
-    MERGE (p:payload {dt: $payload, timestamp: datetime($timestamp)})
+def graph_query(merge_payload):
+    """The MERGE query for a list of transactions in $rows, with merge_payload creating or matching the payload node p."""
+    return """
+    UNWIND $rows AS row
+    MERGE (pi:PlantID {dt: row.plant_id})
+    MERGE (bi:BuildingID {dt: row.building_id})
+    MERGE (mi:MachineID {dt: row.machine_id})
+    MERGE (cp:CpaID {dt: row.cpaid})
+    MERGE (cid:ConversationID {dt: row.conversationid})
+    MERGE (s:Service {dt: row.service})
+    MERGE (a:Action {dt: row.action})
+    MERGE (dl:DustLevel {dt: row.dust})
+    MERGE (sr:StickyResidu {dt: row.sticky})
+    MERGE (od:Odor {dt: row.odor})
+    """ + merge_payload + """
     MERGE (pi)-[:HAS_CID]->(cid)
     MERGE (pi)-[:LOCATES]->(bi)
     MERGE (pi)-[:HAS_CPA]->(cp)
@@ -52,21 +60,221 @@ def create_graph(tx, transaction):
     MERGE (mi)-[:HAS_STICKYRESIDU]->(sr)
     MERGE (mi)-[:HAS_ODOR]->(od)
     MERGE (mi)-[:NEEDS_CLEANING]->(od)
+    RETURN count(*) AS written
+    """
+
+def payload_query(merge_payload):
+    """The query for transactions whose dimension nodes and relationships exist, only the payload node and its edge are merged."""
+    return """
+    UNWIND $rows AS row
+    MATCH (mi:MachineID {dt: row.machine_id})
+    """ + merge_payload + """
+    MERGE (mi)-[:HAS_PAYLOAD]->(p)
+    RETURN count(*) AS written
+    """
+
+# ReadingBucket properties summed per batch, the averages are derived from them
+BUCKET_COLUMNS = ['count'] + [f"sum_{level}" for level in LEVELS] + list(CLEANING_COLUMNS.values())
+
+# Merged on the messageid when the gateway sent one, a redelivered message matches the node stored before
+MERGE_BY_MESSAGEID = "MERGE (p:payload {messageid: row.messageid}) ON CREATE SET p.dt = row.payload, p.timestamp = row.timestamp"
+MERGE_BY_PAYLOAD = "MERGE (p:payload {dt: row.payload, timestamp: row.timestamp})"
+GRAPH_QUERIES = (graph_query(MERGE_BY_MESSAGEID), graph_query(MERGE_BY_PAYLOAD))
+PAYLOAD_QUERIES = (payload_query(MERGE_BY_MESSAGEID), payload_query(MERGE_BY_PAYLOAD))
+
+def run_queries(tx, queries, transactions):
+    """Runs the first query for the transactions with a messageid and the second for the others, returns the rows written."""
+    written = 0
+    for query, rows in zip(queries, (
+        [transaction for transaction in transactions if message_id(transaction) is not None],
+        [transaction for transaction in transactions if message_id(transaction) is None],
+    )):
+        if rows:
+            written += tx.run(query, rows=rows).single()["written"]
+    return written
+
+def dimension_edges(transaction):
+    """The dimension relationships graph_query merges for a transaction, as (from label, from dt, type, to dt) keys."""
+    plant, building, machine = transaction['plant_id'], transaction['building_id'], transaction['machine_id']
+    conversation = transaction['conversationid']
+    return (
+        ('PlantID', plant, 'HAS_CID', conversation),
+        ('PlantID', plant, 'LOCATES', building),
+        ('PlantID', plant, 'HAS_CPA', transaction['cpaid']),
+        ('BuildingID', building, 'HAS_CID', conversation),
+        ('BuildingID', building, 'HAS', machine),
+        ('BuildingID', building, 'HAS_SERVICE', transaction['service']),
+        ('MachineID', machine, 'HAS_CID', conversation),
+        ('MachineID', machine, 'HAS_ACTION', transaction['action']),
+        ('MachineID', machine, 'HAS_DUSTLEVEL', transaction['dust']),
+        ('MachineID', machine, 'HAS_STICKYRESIDU', transaction['sticky']),
+        # NEEDS_CLEANING is merged with HAS_ODOR, between the same nodes
+        ('MachineID', machine, 'HAS_ODOR', transaction['odor']),
+    )
+
+# Aggregates of the readings of a machine in a time bucket, incremented per batch
+BUCKET_QUERY = """
+    UNWIND $buckets AS row
+    MATCH (mi:MachineID {dt: row.machine_id})
+    MERGE (b:ReadingBucket {key: row.key})
+    ON CREATE SET b.machine = row.machine_id, b.start = row.start, b.seconds = row.seconds, b.count = 0,
+        """ + ", ".join(f"b.{column} = 0" for column in BUCKET_COLUMNS[1:]) + """
+    SET """ + ", ".join(f"b.{column} = b.{column} + row.{column}" for column in BUCKET_COLUMNS) + """
+    SET """ + ", ".join(f"b.avg_{level} = toFloat(b.sum_{level}) / b.count" for level in LEVELS) + """
+    MERGE (mi)-[:HAS_BUCKET]->(b)
     """
-    transaction['txid'] = str(uuid.uuid4())
-    tx.run(query, **transaction)
+
+def bucket_rows(transactions):
+    """Per machine and bucket of NEO4J_BUCKET_SECONDS the count, level sums and cleaning class counts of a batch.
+
+    Readings with an unparsable level are left out, as in the sqlite rollups."""
+    buckets = {}
+    for transaction in transactions:
+        levels = [to_int(transaction[level]) for level in LEVELS]
+        if None in levels:
+            continue
+        start = int(transaction['timestamp'].timestamp()) // NEO4J_BUCKET_SECONDS * NEO4J_BUCKET_SECONDS
+        key = f"{transaction['machine_id']}/{start}"
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = dict.fromkeys(BUCKET_COLUMNS, 0)
+            bucket.update(key=key, machine_id=transaction['machine_id'], start=datetime.datetime.fromtimestamp(start, datetime.timezone.utc), seconds=NEO4J_BUCKET_SECONDS)
+        bucket['count'] += 1
+        for level, value in zip(LEVELS, levels):
+            bucket[f"sum_{level}"] += value
+        if transaction['cleaning'] in CLEANING_COLUMNS:
+            bucket[CLEANING_COLUMNS[transaction['cleaning']]] += 1
+    return list(buckets.values())
+
+def drop_stored(tx, transactions):
+    """The transactions whose messageid has no payload node yet, and only the first of repeats within the batch."""
+    ids = list({message_id(transaction) for transaction in transactions} - {None})
+    if not ids:
+        return transactions
+    stored = set(tx.run("UNWIND $ids AS id MATCH (p:payload {messageid: id}) RETURN collect(id) AS ids", ids=ids).single()["ids"])
+    new = []
+    for transaction in transactions:
+        id = message_id(transaction)
+        if id is not None:
+            if id in stored:
+                continue
+            stored.add(id)
+        new.append(transaction)
+    return new
+
+def create_graph(tx, transactions):
+    """Create nodes and relationships in Neo4j, one UNWIND query per payload merge instead of a query per transaction.
+
+    Transactions whose payload node exists already are skipped. Transactions whose dimension
+    relationships were all merged before skip those MERGEs. When one of their machines is gone,
+    removed behind this subscriber's back, the cache is dropped and they get the full MERGE too. With
+    NEO4J_BUCKET_SECONDS the readings are also added to their machine's bucket aggregates. Returns the
+    transactions stored and those that got the full MERGE."""
+    # Counted into the buckets once, a redelivered reading has its payload node already
+    transactions = drop_stored(tx, transactions)
+    known = []
+    merged = []
+    for transaction in transactions:
+        (known if all(edge in ensured for edge in dimension_edges(transaction)) else merged).append(transaction)
+    if known and run_queries(tx, PAYLOAD_QUERIES, known) < len(known):
+        # MERGE again matches the payload nodes just written for the machines that were found
+        ensured.clear()
+        merged += known
+    if merged:
+        run_queries(tx, GRAPH_QUERIES, merged)
+    if NEO4J_BUCKET_SECONDS and transactions:
+        tx.run(BUCKET_QUERY, buckets=bucket_rows(transactions))
+    return transactions, merged
+
+# Time of the last payload pruning
+prune_run = 0
+
+def prune_payloads():
+    """Deletes payload nodes older than NEO4J_PAYLOAD_RETENTION seconds, at most once per NEO4J_RETENTION_INTERVAL seconds."""
+    global prune_run
+    if not NEO4J_PAYLOAD_RETENTION or time.time() - prune_run < NEO4J_RETENTION_INTERVAL:
+        return
+    prune_run = time.time()
+    try:
+        # Auto-commit, CALL IN TRANSACTIONS deletes in chunks of short transactions
+        summary = session.run("""
+            MATCH (p:payload) WHERE p.timestamp < datetime() - duration({seconds: $seconds})
+            CALL { WITH p DETACH DELETE p } IN TRANSACTIONS OF 10000 ROWS
+        """, seconds=NEO4J_PAYLOAD_RETENTION).consume()
+        if summary.counters.nodes_deleted:
+            tprint(f"Retention: deleted {summary.counters.nodes_deleted} payload nodes older than {NEO4J_PAYLOAD_RETENTION}s")
+    except Exception as e:
+        tprint(f"Retention failed: {e}")
+
+def to_datetime(timestamp):
+    """The datetime Cypher's datetime() makes of a timestamp text, UTC when it has no offset. None if unparsable."""
+    try:
+        dt = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    return dt if dt.tzinfo is not None else dt.replace(tzinfo=datetime.timezone.utc)
 
 def initialize_neo4j():
     """Initialize Neo4j database connection."""
     return GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
 
+# Node labels merged on their dt property
+UNIQUE_LABELS = ('PlantID', 'BuildingID', 'MachineID', 'CpaID', 'ConversationID', 'Service', 'Action', 'DustLevel', 'StickyResidu', 'Odor')
+
+def create_constraints(neo4j_driver):
+    """Unique constraints on the merged nodes.
+
+    MERGE alone is check-then-create, two subscribers merging the same new machine at once both
+    create it. With the constraint the second one waits for the first and matches its node, and the
+    backing index makes every MERGE a lookup instead of a label scan."""
+    with neo4j_driver.session() as session:
+        for label in UNIQUE_LABELS:
+            session.run(f"CREATE CONSTRAINT {label.lower()}_dt IF NOT EXISTS FOR (n:{label}) REQUIRE n.dt IS UNIQUE")
+        # Payload nodes without a messageid are not covered, they come from a gateway before MessageId was passed on
+        session.run("CREATE CONSTRAINT payload_messageid IF NOT EXISTS FOR (n:payload) REQUIRE n.messageid IS UNIQUE")
+        session.run("CREATE CONSTRAINT readingbucket_key IF NOT EXISTS FOR (n:ReadingBucket) REQUIRE n.key IS UNIQUE")
+        # Lets the retention find the old payload nodes without a label scan
+        session.run("CREATE INDEX payload_timestamp IF NOT EXISTS FOR (n:payload) ON (n.timestamp)")
+
 def tprint(string=""):
     """Takes a string and prints it with a timestamp prefixt."""
     print('[{}] {}'.format(time.strftime("%Y-%m-%d %H:%M:%S"), string))
 
 def process_and_store(message: InboundMessage):
     data = message.get_payload_as_string()
-    insert_transaction(data, neo4j_driver)
+    try:
+        transaction = json.loads(data)
+    except (TypeError, ValueError) as e:
+        # Redelivering would fail the same way, acknowledge and skip it
+        tprint(f"Skipping message that is not valid JSON: {e}")
+        receiver.ack(message)
+        return
+    reason = malformed(transaction)
+    if reason is None and any(transaction[field] is None for field in FIELDS):
+        # MERGE cannot match a node on a null property
+        reason = "an empty plant, building, machine, ebXML or level field"
+    if reason is not None:
+        tprint(f"Skipping message that cannot be stored, {reason}: {data[:200]}")
+        receiver.ack(message)
+        return
+    if message_id(transaction) in recent_ids:
+        # Stored before, a redelivery or a reading the gateway published twice, acknowledged without a write
+        duplicates.inc()
+        receiver.ack(message)
+        return
+    # Converted here, one unparsable timestamp would fail the whole batch in datetime()
+    transaction['timestamp'] = to_datetime(transaction.get('timestamp'))
+    if transaction['timestamp'] is None:
+        tprint(f"Skipping message with an unparsable timestamp: {data[:200]}")
+        receiver.ack(message)
+        return
+    # Written and acknowledged with the next batch
+    writer.submit(transaction, message)
+
+def acknowledge(messages):
+    """BatchWriter on_flushed: the batch is committed, the broker can delete its messages."""
+    for message in messages:
+        receiver.ack(message)
 
 if __name__ == "__main__":
     # Load values from the configuration
@@ -90,11 +298,31 @@ if __name__ == "__main__":
     NEO4J_PASSWORD = os.environ["NEO4J_PASSWORD"]
     NEO4J_URI = os.environ["NEO4J_URI"]
     NEO4J_CONSOLE = os.environ["NEO4J_CONSOLE"]
+    # Worker threads writing to Neo4j, each machine always on the same worker to keep its order
+    NEO4J_WORKERS = config.get("neo4j.workers", 4)
+    NEO4J_WORKER_QUEUE = config.get("neo4j.worker_queue", 1000)
+    # Queue depth and processing time on http://localhost:<metrics_port>/metrics, 0 disables
+    NEO4J_METRICS_PORT = config.get("neo4j.metrics_port", 54324)
+    # Consumer group: several subscriber processes share the non-exclusive queue
+    NEO4J_CONSUMER_GROUP = config.get("neo4j.consumer_group", False)
+    # Message ids kept in memory to drop redelivered messages without a database round trip
+    NEO4J_DEDUP_CACHE = config.get("neo4j.dedup_cache", 100000)
+    # Write up to batch_rows messages or what arrived within batch_delay_ms in one UNWIND query
+    NEO4J_BATCH_ROWS = config.get("neo4j.batch_rows", 500)
+    NEO4J_BATCH_DELAY_MS = config.get("neo4j.batch_delay_ms", 50)
+    # Dimension relationships known to exist, transactions with only known ones skip their MERGEs
+    NEO4J_DIMENSION_CACHE = config.get("neo4j.dimension_cache", 10000)
+    # Add every reading to a ReadingBucket node per machine and bucket_seconds, 0 disables
+    NEO4J_BUCKET_SECONDS = config.get("neo4j.bucket_seconds", 0)
+    # Delete payload nodes older than payload_retention seconds, checked every retention_interval seconds, 0 keeps them forever
+    NEO4J_PAYLOAD_RETENTION = config.get("neo4j.payload_retention", 0)
+    NEO4J_RETENTION_INTERVAL = config.get("neo4j.retention_interval", 3600)
 
     # Initialize Neo4j database
     try:
         neo4j_driver = initialize_neo4j()
         neo4j_driver.verify_connectivity()
+        create_constraints(neo4j_driver)
         tprint(f"- Neo4j database running at {NEO4J_URI}, Neo4j Browser at {NEO4J_CONSOLE}")
     except Exception as e:
         tprint(f"- Neo4j database not connected: {e}")
@@ -142,15 +370,35 @@ if __name__ == "__main__":
     try:
         # Create queue receiver using hardcoded queue name from config.json
         QUEUE_NAME = 'CUSTOM-QNAME-neo4j-json'
-        queue = Queue.durable_exclusive_queue(QUEUE_NAME) 
+        # Non-exclusive: the broker spreads the messages over all subscribers bound to the queue
+        queue = Queue.durable_non_exclusive_queue(QUEUE_NAME) if NEO4J_CONSUMER_GROUP else Queue.durable_exclusive_queue(QUEUE_NAME)
         receiver = messaging_service.create_persistent_message_receiver_builder().build(queue)
         receiver.start()
-        handler = MyMessageHandler(process_and_store)
+        metrics = MetricsRegistry()
+        recent_ids = RecentIdCache(NEO4J_DEDUP_CACHE)
+        ensured = RecentIdCache(NEO4J_DIMENSION_CACHE)
+        duplicates = metrics.counter("subscriber_duplicates_total", "Messages dropped because their messageid was stored before")
+        # One session for all batches, used by the writer thread only
+        session = neo4j_driver.session()
+        # Only type and constraint errors are errors of the row, an unreachable or busy database is retried
+        writer = BatchWriter(insert_transactions, NEO4J_BATCH_ROWS, NEO4J_BATCH_DELAY_MS, acknowledge,
+                             data_errors=(CypherTypeError, ConstraintError, KeyError, TypeError, ValueError), metrics=metrics, name="neo4j-writer")
+        metrics.gauge("subscriber_batch_pending", "Messages waiting for the batch writer", callback=writer.qsize)
+        # Acknowledged by the batch writer after the commit, not when the worker is done
+        dispatcher = KeyedDispatcher(process_and_store, machine_key, NEO4J_WORKERS, NEO4J_WORKER_QUEUE, metrics=metrics, name="neo4j-worker")
+        if NEO4J_METRICS_PORT:
+            serve_metrics(metrics, port=NEO4J_METRICS_PORT)
+        handler = MyMessageHandler(dispatcher.dispatch)
         receiver.receive_async(handler)
         tprint("Receiver is running. Press Ctrl+C to stop.")
         while True:
             time.sleep(1)  # Keeps the main thread alive
     except KeyboardInterrupt:
         tprint("Shutting down...")
+        # Write and acknowledge what was received, messages arriving meanwhile are not acknowledged and get redelivered
+        dispatcher.close()
+        writer.close()
         receiver.terminate()
+        session.close()
+        neo4j_driver.close()
         messaging_service.disconnect()
@@ -15,71 +15,76 @@ from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 # ez
 from ez_config_loader import ConfigLoader
+from ez_batch_writer import BatchWriter
+from ez_anomaly import IncrementalDetector
+from ez_machine_stats import MachineStats
+from ez_report import ReportWriter
+from ez_sqlite_schema import migrate, malformed, Dimensions, INSERT_READING
+from ez_rollups import update_rollups, apply_retention
+from ez_dispatcher import KeyedDispatcher, machine_key
+from ez_metrics import MetricsRegistry, serve_metrics
+from ez_lease import Lease
+from ez_dedup import RecentIdCache, message_id
 
-def initialize_db(db_name):
-    """Initialize the sqlite database and create a transactions table."""
+def initialize_db(db_name, synchronous="FULL", busy_timeout=5000):
+    """Initialize the sqlite database and bring its schema to the current version."""
     # Use a file based database not memory to be able to access for read and writeb from multiple processes (Python scripts)
     #conn = sqlite3.connect(':memory:', check_same_thread=False)
     conn = sqlite3.connect(db_name, check_same_thread=False)
     cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            plant_id TEXT,
-            building_id TEXT,
-            machine_id TEXT,
-            payload TEXT,
-            cpaid TEXT,
-            conversationid TEXT,
-            service TEXT,
-            action TEXT,
-            timestamp TEXT,
-            dust TEXT,
-            sticky TEXT,
-            odor TEXT,
-            cleaning TEXT,
-            dli INTEGER,
-            sri INTEGER,
-            odi INTEGER
-        )
-    ''')
+    # WAL: a commit appends to the log instead of rewriting pages, and the dashboard can read while the subscriber writes
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # FULL syncs the log on every commit, messages are acknowledged after the commit so none are lost on power failure
+    cursor.execute(f"PRAGMA synchronous={synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # Creates the readings and dimension tables, or converts an older transactions table
+    migrate(conn, log=tprint)
     conn.commit()
     return conn
 
-def insert_transaction(conn, transaction_json):
-    """Run external fraud check then insert transaction and fraud score into SQLite."""
-    cursor = conn.cursor()
-    transaction = json.loads(transaction_json)
-
-    # Insert into SQLite
-    cursor.execute('''
-        INSERT INTO transactions (
-            plant_id,
-            building_id,
-            machine_id,
-            payload,
-            cpaid,
-            conversationid,
-            service,
-            action,
-            timestamp,
-            dust,
-            sticky,
-            odor,
-            cleaning,
-            dli,
-            sri,
-            odi
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        transaction['plant_id'], transaction['building_id'], transaction['machine_id'],
-        transaction['payload'], transaction['cpaid'], transaction['conversationid'],
-        transaction['service'], transaction['action'], transaction['timestamp'],
-        transaction['dust'], transaction['sticky'], transaction['odor'],
-        transaction['cleaning'],transaction['dli'],transaction['sri'],transaction['odi']
-    ))
-    conn.commit()
-    tprint("Inserted transaction into SQLite.")
+def insert_transactions(conn, transactions, stats=None, dimensions=None):
+    """Insert a batch of parsed transactions in a single transaction, one commit and fsync for all.
+
+    Names are stored as ids of the dimension tables, the rollups and with stats the per-machine
+    aggregates are updated in the same transaction. Transactions with a messageid already stored are
+    skipped. Returns the id of the last inserted row and the inserted transactions, which have the ids
+    up to it: the write lock is taken up front, so other subscribers on the same database cannot insert
+    in between."""
+    dimensions = dimensions or Dimensions(conn)
+    with conn:
+        # IMMEDIATE, waits up to busy_timeout for other writers instead of failing when a read turns into a write
+        conn.execute("BEGIN IMMEDIATE")
+        transactions = drop_stored(conn, transactions)
+        if not transactions:
+            return None, transactions
+        rows, pending = dimensions.encode(conn, transactions)
+        conn.executemany(INSERT_READING, rows)
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        update_rollups(conn, rows, [transaction['cleaning'] for transaction in transactions])
+        if stats is not None:
+            stats_rows = stats.write(conn, transactions)
+    # Only after the commit, a failed batch is retried and must not be counted twice
+    dimensions.apply(pending)
+    if stats is not None:
+        stats.apply(stats_rows)
+    return last_id, transactions
+
+def drop_stored(conn, transactions):
+    """The transactions whose messageid is not in the readings yet, and only the first of repeats within the batch."""
+    ids = list({message_id(transaction) for transaction in transactions} - {None})
+    if not ids:
+        return transactions
+    stored = {row[0] for row in conn.execute(f"SELECT messageid FROM readings WHERE messageid IN ({','.join('?' * len(ids))})", ids)}
+    new = []
+    for transaction in transactions:
+        id = message_id(transaction)
+        if id is not None:
+            if id in stored:
+                continue
+            stored.add(id)
+        new.append(transaction)
+    return new
 
 def tprint(string=""):
     """Takes a string and prints it with a timestamp prefixt."""
@@ -87,9 +92,117 @@ def tprint(string=""):
 
 def process_and_store(message: InboundMessage):
     data = message.get_payload_as_string()
-    # analysis
-    insert_transaction(conn, data)
-    analyze_risk(conn)
+    try:
+        transaction = json.loads(data)
+    except (TypeError, ValueError) as e:
+        # Redelivering would fail the same way, acknowledge and skip it
+        tprint(f"Skipping message that is not valid JSON: {e}")
+        receiver.ack(message)
+        return
+    reason = malformed(transaction)
+    if reason is not None:
+        tprint(f"Skipping message that cannot be stored, {reason}: {data[:200]}")
+        receiver.ack(message)
+        return
+    if message_id(transaction) in recent_ids:
+        # Stored before, a redelivery or a reading the gateway published twice
+        duplicates.inc()
+        receiver.ack(message)
+        return
+    # Written and acknowledged with the next batch
+    writer.submit(transaction, message)
+
+def store_batch(transactions):
+    """BatchWriter flush: insert the batch, then run the analysis on the writer thread."""
+    last_id, inserted = insert_transactions(conn, transactions, machine_stats, dimensions)
+    # Duplicates the cache did not know, e.g. from before a restart or stored by another subscriber
+    duplicates.inc(len(transactions) - len(inserted))
+    recent_ids.update(message_id(transaction) for transaction in inserted)
+    if APP_DEBUG:
+        tprint(f"Inserted {len(inserted)} transactions into SQLite.")
+    # analysis, the batch is committed so a failure here must not make the writer insert it again
+    try:
+        if lease is not None:
+            # Consumer group: the leader analyzes what all subscribers stored
+            if not lead():
+                return
+            if SQLITE_ANALYSIS == "incremental":
+                analyze_pending(conn)
+            else:
+                analyze_risk(conn)
+        elif SQLITE_ANALYSIS == "incremental":
+            if inserted:
+                df = pd.DataFrame(inserted)
+                df.insert(0, 'id', range(last_id - len(inserted) + 1, last_id + 1))
+                analyze_new(conn, df)
+        else:
+            analyze_risk(conn)
+    except Exception as e:
+        tprint(f"Risk analysis failed: {e}")
+    enforce_retention()
+
+def lead():
+    """True while this subscriber holds the analysis lease, catching up with the previous leader when it takes over."""
+    held = lease.held
+    if not lease.acquire():
+        return False
+    if not held:
+        tprint(f"Leading the consumer group as {lease.owner}: analysis and retention run here")
+        # The previous leader may have reported and trained on more since this process started
+        report_writer.reopen()
+        prime_detector()
+    return True
+
+def prime_detector():
+    """A new detector started from the latest stored transactions instead of an empty model."""
+    global detector
+    detector = IncrementalDetector(SQLITE_MODEL_WINDOW, SQLITE_RETRAIN_EVERY, SQLITE_MODEL_SAMPLING)
+    if SQLITE_ANALYSIS == "incremental":
+        recent = conn.execute("SELECT dli, sri, odi FROM transactions WHERE dli IS NOT NULL AND sri IS NOT NULL AND odi IS NOT NULL ORDER BY id DESC LIMIT ?", (SQLITE_MODEL_WINDOW,)).fetchall()
+        detector.add(recent[::-1])
+
+def analyze_pending(conn, limit=10000):
+    """Consumer group leader: score the transactions stored by any subscriber since the last analysis."""
+    position = lease.position()
+    if position is None:
+        # First leader of this database, start with what arrives from now on
+        position = conn.execute("SELECT COALESCE(MAX(id), 0) FROM readings").fetchone()[0]
+        lease.advance(position)
+        return
+    df = pd.read_sql_query("SELECT * FROM transactions WHERE id > ? ORDER BY id LIMIT ?", conn, params=(position, limit))
+    if df.empty:
+        return
+    last_id = int(df['id'].iloc[-1])
+    df = df.drop(columns=['timestamp_us']).dropna(subset=['dli', 'sri', 'odi'])
+    # The other subscribers updated the per-machine aggregates too
+    machine_stats.load(conn)
+    if not df.empty:
+        analyze_new(conn, df)
+    lease.advance(last_id)
+
+# Time of the last retention run
+retention_run = 0
+
+def enforce_retention():
+    """Deletes or archives data past its retention, at most once per SQLITE_RETENTION_INTERVAL seconds."""
+    global retention_run
+    if time.time() - retention_run < SQLITE_RETENTION_INTERVAL:
+        return
+    if lease is not None and not lease.acquire():
+        return
+    retention_run = time.time()
+    try:
+        apply_retention(conn, SQLITE_RETENTION, SQLITE_ARCHIVE_DB, log=tprint)
+    except Exception as e:
+        tprint(f"Retention failed: {e}")
+
+def acknowledge(messages):
+    """BatchWriter on_flushed: the batch is committed, the broker can delete its messages."""
+    for message in messages:
+        receiver.ack(message)
+
+# Transactions count at the last analysis, the table grows in batches so it rarely hits an exact multiple
+analyzed_count = 0
 
 def analyze_risk(conn):
     """Analyze transaction patterns using Isolation Forest to detect anomalies."""
@@ -98,10 +211,11 @@ def analyze_risk(conn):
     len_df = pd.read_sql_query("SELECT COUNT(*) FROM transactions", conn).iloc[0, 0]
     
     # Only train when nt new transactions are added
-    nt = 20
-    mod = len_df % nt
-    if mod != 0:
+    global analyzed_count
+    nt = SQLITE_ANALYZE_EVERY
+    if len_df // nt == analyzed_count // nt:
         return
+    analyzed_count = len_df
 
     # Only train when mt minimum transactions is available
     if len_df < 10:
@@ -132,7 +246,38 @@ def analyze_risk(conn):
     df_sum = df[['dli', 'sri', 'odi']].sum(axis=1)  # sum per row (Series)
     df['peer_deviation'] = abs(df_sum - peer_sum) / peer_sum
 
+    report_risk(df)
+    return
 
+def analyze_new(conn, df):
+    """Score only the new transactions, a DataFrame with their ids, against the current model, which retrains in the background."""
+    features = ['dli', 'sri', 'odi']
+    # The gateway sends the levels as strings, "Unknown" when missing, the table stores them as integers or NULL
+    df[features] = df[features].apply(pd.to_numeric, errors='coerce')
+    df = df.dropna(subset=features)
+    if df.empty:
+        return
+    df[features] = df[features].astype(int)
+    X = df[features].to_numpy(dtype=float)
+    # Score before adding, new readings are judged by a model of the readings before them
+    scores = detector.score(X)
+    detector.add(X)
+    if scores is None:
+        # No model trained yet, nothing counts as an anomaly
+        df['anomaly_score'] = 0.0
+        df['is_anomaly'] = 1
+    else:
+        df['anomaly_score'], df['is_anomaly'] = scores
+
+    # Peer-group means from the running per-machine aggregates, already updated with this batch
+    peer_sum = df['machine_id'].map(machine_stats.peer_sum)
+    df_sum = df[features].sum(axis=1)
+    df['peer_deviation'] = abs(df_sum - peer_sum) / peer_sum
+
+    report_risk(df)
+
+def report_risk(df):
+    """Rule-based checks on top of the anomaly and peer deviation columns, then report the risky transactions."""
     # Rule-based checks: Flagging risky payment types and high-risk bank locations
     high_risk_dust = ['high']
     high_risk_sticky = ['excessive']
@@ -160,12 +305,9 @@ def analyze_risk(conn):
     tprint(low_risk_title)
     tprint(low_risk_transactions)
     tprint(f"{bcolors.ENDC}")
-    report_file = open(REPORT_FILE, "a")
-    report_file.write(high_risk_title)
-    report_file.write(high_risk_transactions.to_string())
+    # Only transactions not reported before, one JSON object per line
     # Not printing low risk, lots of data
-    #report_file.write(low_risk_title)    
-    #report_file.write(low_risk_transactions.to_string())
+    report_writer.write(high_risk_transactions.to_dict('records'))
     return
 
 class bcolors:
@@ -198,17 +340,62 @@ if __name__ == "__main__":
     SOLACE_TCP_PROTOCOL = os.environ["SOLACE_TCP_PROTOCOL"]
 
     REPORT_FILE = config.get("app.report_file")
+    # Rotate the report when it reaches this size in bytes or age in seconds, keeping this many rotated files
+    REPORT_MAX_BYTES = config.get("app.report_max_bytes", 10485760)
+    REPORT_MAX_AGE = config.get("app.report_max_age", 86400)
+    REPORT_KEEP = config.get("app.report_keep", 7)
 
     SQLITE_DB_NAME = os.environ["SQLITE_DB_NAME"]
+    # Group commit: write up to batch_rows messages or what arrived within batch_delay_ms in one transaction
+    SQLITE_BATCH_ROWS = config.get("sqlite.batch_rows", 500)
+    SQLITE_BATCH_DELAY_MS = config.get("sqlite.batch_delay_ms", 50)
+    # NORMAL is faster but can lose the last acknowledged transactions on power failure
+    SQLITE_SYNCHRONOUS = config.get("sqlite.synchronous", "FULL")
+    SQLITE_BUSY_TIMEOUT = config.get("sqlite.busy_timeout", 5000)
+    # incremental: score each batch against a model retrained in the background every retrain_every transactions
+    # on a sliding window or reservoir sample of model_window transactions
+    # full: retrain on and rescore the whole table each time analyze_every transactions were added
+    SQLITE_ANALYSIS = config.get("sqlite.analysis", "incremental")
+    SQLITE_ANALYZE_EVERY = config.get("sqlite.analyze_every", 20)
+    SQLITE_MODEL_WINDOW = config.get("sqlite.model_window", 5000)
+    SQLITE_MODEL_SAMPLING = config.get("sqlite.model_sampling", "sliding")
+    SQLITE_RETRAIN_EVERY = config.get("sqlite.retrain_every", 1000)
+    # Half-life in seconds of the per-machine aggregates used for peer deviation, 0 weighs all history equally
+    SQLITE_STATS_HALF_LIFE = config.get("sqlite.stats_half_life", 0)
+    # Days to keep raw readings and minute, hour and day rollups, 0 keeps them forever
+    SQLITE_RETENTION = config.get("sqlite.retention", {"raw": 0, "minute": 0, "hour": 0, "day": 0})
+    # Copy raw readings to this sqlite file before deleting them, empty only deletes
+    SQLITE_ARCHIVE_DB = config.get("sqlite.archive_db", "")
+    SQLITE_RETENTION_INTERVAL = config.get("sqlite.retention_interval", 3600)
+    # Worker threads parsing messages, each machine always on the same worker to keep its order
+    SQLITE_WORKERS = config.get("sqlite.workers", 4)
+    SQLITE_WORKER_QUEUE = config.get("sqlite.worker_queue", 1000)
+    # Queue depth and processing time on http://localhost:<metrics_port>/metrics, 0 disables
+    SQLITE_METRICS_PORT = config.get("sqlite.metrics_port", 54323)
+    # Consumer group: several subscriber processes share the non-exclusive queue and the database,
+    # the one holding the lease (renewed within lease_ttl seconds) runs the analysis and retention
+    SQLITE_CONSUMER_GROUP = config.get("sqlite.consumer_group", False)
+    SQLITE_LEASE_TTL = config.get("sqlite.lease_ttl", 30)
+    # Message ids kept in memory to drop redelivered messages without a database lookup
+    SQLITE_DEDUP_CACHE = config.get("sqlite.dedup_cache", 100000)
 
     # Initialize SQLite database (would be Neo4j, MongoDB Atlas, bank system, combination...)
     try:
-        conn = initialize_db(SQLITE_DB_NAME)
+        conn = initialize_db(SQLITE_DB_NAME, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT)
         tprint("- SQLite database running, SQLite Web browser at  at http://localhost:8191")
     except Exception as e:
         tprint(f"- SQLite database not running: {e}")
         quit()
 
+    dimensions = Dimensions(conn)
+    machine_stats = MachineStats(conn, SQLITE_STATS_HALF_LIFE)
+    report_writer = ReportWriter(REPORT_FILE, REPORT_MAX_BYTES, REPORT_MAX_AGE, REPORT_KEEP)
+    prime_detector()
+    lease = Lease(conn, "sqlite-analysis", SQLITE_LEASE_TTL) if SQLITE_CONSUMER_GROUP else None
+    recent_ids = RecentIdCache(SQLITE_DEDUP_CACHE)
+    # Messages stored but not acknowledged before a restart are redelivered first, have their ids at hand
+    recent_ids.update(row[0] for row in conn.execute("SELECT messageid FROM readings WHERE messageid IS NOT NULL ORDER BY id DESC LIMIT ?", (SQLITE_DEDUP_CACHE,)).fetchall()[::-1])
+
     broker_props = {
         "solace.messaging.transport.host": f"{SOLACE_TCP_PROTOCOL}{SOLACE_HOST}:{SOLACE_SMF_PORT}",
         "solace.messaging.service.vpn-name": SOLACE_MESSAGE_VPN,
@@ -251,15 +438,32 @@ if __name__ == "__main__":
     try:
         # Create queue receiver using hardcoded queue name from config.json
         QUEUE_NAME = 'CUSTOM-QNAME-sqlite-json'
-        queue = Queue.durable_exclusive_queue(QUEUE_NAME) 
+        # Non-exclusive: the broker spreads the messages over all subscribers bound to the queue
+        queue = Queue.durable_non_exclusive_queue(QUEUE_NAME) if SQLITE_CONSUMER_GROUP else Queue.durable_exclusive_queue(QUEUE_NAME)
         receiver = messaging_service.create_persistent_message_receiver_builder().build(queue)
         receiver.start()
-        handler = MyMessageHandler(process_and_store)
+        metrics = MetricsRegistry()
+        duplicates = metrics.counter("subscriber_duplicates_total", "Messages dropped because their messageid was stored before")
+        # Only constraint and binding errors are errors of the row, a locked database is retried
+        writer = BatchWriter(store_batch, SQLITE_BATCH_ROWS, SQLITE_BATCH_DELAY_MS, acknowledge,
+                             data_errors=(sqlite3.IntegrityError, sqlite3.InterfaceError, KeyError, TypeError, ValueError), metrics=metrics, name="sqlite-writer")
+        metrics.gauge("subscriber_batch_pending", "Messages waiting for the batch writer", callback=writer.qsize)
+        # Acknowledged by the batch writer after the commit, not when the worker is done
+        dispatcher = KeyedDispatcher(process_and_store, machine_key, SQLITE_WORKERS, SQLITE_WORKER_QUEUE, metrics=metrics, name="sqlite-worker")
+        if SQLITE_METRICS_PORT:
+            serve_metrics(metrics, port=SQLITE_METRICS_PORT)
+        handler = MyMessageHandler(dispatcher.dispatch)
         receiver.receive_async(handler)
         tprint("Receiver is running. Press Ctrl+C to stop.")
         while True:
             time.sleep(1)  # Keeps the main thread alive
     except KeyboardInterrupt:
         tprint("Shutting down...")
+        # Write and acknowledge what was received, messages arriving meanwhile are not acknowledged and get redelivered
+        dispatcher.close()
+        writer.close()
         receiver.terminate()
+        if lease is not None:
+            lease.release()
+        report_writer.close()
         messaging_service.disconnect()